@@ -0,0 +1,348 @@
+"""
+Benchmarks for the One Job API
+
+Each benchmark seeds a fresh in-memory SQLite database (the same setup the
+test suite's `client` fixture uses), drives the app through TestClient and
+prints per-operation timings for a range of deck sizes.
+
+    python benchmark.py ranks              # defer/complete/reactivate cost
+    python benchmark.py ranks --sizes 100 1000 10000 --ops 200
+    python benchmark.py import --size 100000   # bulk NDJSON import
+    python benchmark.py serialize          # task list: ORM + Pydantic vs row path
+    python benchmark.py startup            # cold start: import and first response
+
+    # Every endpoint against seeded 1k/10k/100k decks, saved as JSON and
+    # checked against an earlier run; exits 1 if any p50 regressed.
+    python benchmark.py api --output results.json
+    python benchmark.py api --sizes 1000 10000 --baseline results.json --tolerance 0.25
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import uuid
+
+import httpx
+import orjson
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from main import (
+    app, get_sessionmaker, get_write_sessionmaker, migrate, DBTask, TaskResponse, TASK_TREE,
+    DEFAULT_DECK, read_tasks, response_cache, task_view_query,
+)
+
+
+@contextmanager
+def bench_client():
+    """A TestClient bound to its own in-memory database."""
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    app.dependency_overrides[get_sessionmaker] = lambda: SessionLocal
+    app.dependency_overrides[get_write_sessionmaker] = lambda: SessionLocal
+    try:
+        with TestClient(app) as client:
+            client.portal.call(migrate, engine)
+            client.engine = engine
+            yield client
+            client.portal.call(engine.dispose)
+    finally:
+        app.dependency_overrides.pop(get_sessionmaker, None)
+        app.dependency_overrides.pop(get_write_sessionmaker, None)
+
+
+def seed_tasks(client, count):
+    """Insert `count` todo tasks directly, bypassing the API. Returns their ids."""
+    now = datetime.now(timezone.utc)
+    rows = [
+        {
+            "id": uuid.uuid4(),
+            "title": f"Task {i}",
+            "status": "todo",
+            "completed": False,
+            "created_at": now,
+            "deferral_count": 0,
+            "sort_order": i + 1,
+        }
+        for i in range(count)
+    ]
+
+    async def insert_rows():
+        async with client.engine.begin() as conn:
+            await conn.execute(insert(DBTask), rows)
+
+    client.portal.call(insert_rows)
+    return [row["id"] for row in rows]
+
+
+def seed_deck(client, count, substacks=1, cards=3):
+    """Import `count` todo tasks, each with substacks of cards, through the API."""
+    line = json.dumps({"title": "Task", "description": "Seeded by benchmark.py", "substacks": [
+        {"name": f"Substack {s}", "tasks": [{"title": f"Card {c}"} for c in range(cards)]}
+        for s in range(substacks)
+    ]})
+    body = ("\n".join([line] * count) + "\n").encode()
+    response = client.post("/import", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 201, response.text
+
+
+def timed(call):
+    start = time.perf_counter()
+    response = call()
+    elapsed = time.perf_counter() - start
+    assert response.status_code < 400, response.text
+    return elapsed
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "ops_per_second": len(samples) / sum(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+    }
+
+
+def bench_ranks(sizes, ops):
+    """Per-operation cost of reordering as the deck grows."""
+    results = {}
+    for size in sizes:
+        with bench_client() as client:
+            ids = seed_tasks(client, size)
+            defer, complete, reactivate = [], [], []
+            for i in range(ops):
+                task_id = ids[i % size]
+                defer.append(timed(lambda: client.put(f"/tasks/{task_id}", json={"is_deferral": True})))
+                complete.append(timed(lambda: client.put(f"/tasks/{task_id}", json={"status": "done"})))
+                reactivate.append(timed(lambda: client.put(f"/tasks/{task_id}", json={"status": "todo"})))
+            results[size] = {
+                "defer": summarize(defer),
+                "complete": summarize(complete),
+                "reactivate": summarize(reactivate),
+            }
+    return results
+
+
+def bench_import(size):
+    """Wall time to import `size` tasks (each with a 3-card substack) as NDJSON."""
+    line = json.dumps({"title": "Imported", "substacks": [
+        {"name": "Steps", "tasks": [{"title": "a"}, {"title": "b"}, {"title": "c"}]},
+    ]})
+    body = ("\n".join([line] * size) + "\n").encode()
+    with bench_client() as client:
+        elapsed = timed(lambda: client.post(
+            "/import", content=body, headers={"Content-Type": "application/x-ndjson"}
+        ))
+    return {"tasks": size, "seconds": elapsed, "tasks_per_second": size / elapsed}
+
+
+def bench_serialize(sizes, repeats):
+    """Building the GET /tasks body: ORM objects + Pydantic vs plain rows + orjson."""
+    results = {}
+    for size in sizes:
+        with bench_client() as client:
+            seed_deck(client, size)
+            sessions = async_sessionmaker(client.engine, expire_on_commit=False)
+
+            async def orm_pydantic():
+                # What GET /tasks did before: ORM tree, model_validate, JSON encode
+                async with sessions() as db:
+                    tasks = (await db.execute(task_view_query(DEFAULT_DECK, "todo").options(TASK_TREE))).scalars().all()
+                    return json.dumps([TaskResponse.model_validate(t).model_dump(mode="json") for t in tasks])
+
+            async def rows_orjson():
+                async with sessions() as db:
+                    return orjson.dumps(await read_tasks(db, task_view_query(DEFAULT_DECK, "todo")), option=orjson.OPT_UTC_Z)
+
+            samples = {"orm_pydantic": [], "rows_orjson": []}
+            for _ in range(repeats):
+                for name, build in (("orm_pydantic", orm_pydantic), ("rows_orjson", rows_orjson)):
+                    start = time.perf_counter()
+                    client.portal.call(build)
+                    samples[name].append(time.perf_counter() - start)
+            results[size] = {name: summarize(times) for name, times in samples.items()}
+    return results
+
+
+def bench_api(sizes, ops):
+    """Latency and throughput of each endpoint against a deck of each size.
+
+    Decks are seeded through /import with one three-card substack per task.
+    The response cache is switched off so reads measure the query and
+    serialization path; the full (unpaginated) list is sampled less often
+    because at 100k tasks each call moves the whole deck.
+    """
+    results = {}
+    max_bytes, response_cache.max_bytes = response_cache.max_bytes, 0
+    try:
+        for size in sizes:
+            with bench_client() as client:
+                seed_deck(client, size)
+                page = client.get("/tasks", params={"status": "todo", "limit": min(ops, 200)}).json()
+                ids = [task["id"] for task in page]
+                samples = {name: [] for name in (
+                    "list_page", "list_all", "create", "defer", "complete", "reactivate", "create_substack",
+                    "search",
+                )}
+                for i in range(ops):
+                    task_id = ids[i % len(ids)]
+                    samples["list_page"].append(timed(lambda: client.get("/tasks", params={"status": "todo", "limit": 50})))
+                    samples["create"].append(timed(lambda: client.post("/tasks", json={"title": f"Bench {i}"})))
+                    samples["defer"].append(timed(lambda: client.put(f"/tasks/{task_id}", json={"is_deferral": True})))
+                    samples["complete"].append(timed(lambda: client.put(f"/tasks/{task_id}", json={"status": "done"})))
+                    samples["reactivate"].append(timed(lambda: client.put(f"/tasks/{task_id}", json={"status": "todo"})))
+                    samples["create_substack"].append(timed(
+                        lambda: client.post(f"/tasks/{task_id}/substacks", json={"name": f"Bench {i}"})
+                    ))
+                    samples["search"].append(timed(lambda: client.get("/search", params={"q": f"bench {i}"})))
+                for _ in range(max(3, ops // 20)):
+                    samples["list_all"].append(timed(lambda: client.get("/tasks")))
+                results[size] = {name: summarize(times) for name, times in samples.items()}
+    finally:
+        response_cache.max_bytes = max_bytes
+    return results
+
+
+def bench_startup(repeats):
+    """Cold start, as after the host spins the service down.
+
+    Every sample is a fresh process against an already migrated SQLite file:
+    `interpreter` is a bare `python -c pass`, `import` is `python -c "import
+    main"`, and `first_response` runs from launching uvicorn until it has
+    answered a GET /tasks.
+    """
+    backend = os.path.dirname(os.path.abspath(__file__))
+    samples = {"interpreter": [], "import": [], "first_response": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp}/onejob.db"}
+        subprocess.run([sys.executable, "main.py", "migrate"], cwd=backend, env=env, check=True, capture_output=True)
+        for _ in range(repeats):
+            for name, code in (("interpreter", "pass"), ("import", "import main")):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, "-c", code], cwd=backend, env=env, check=True)
+                samples[name].append(time.perf_counter() - start)
+
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+            start = time.perf_counter()
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                cwd=backend, env=env,
+            )
+            try:
+                while True:
+                    try:
+                        if httpx.get(f"http://127.0.0.1:{port}/tasks").status_code == 200:
+                            break
+                    except httpx.TransportError:
+                        if server.poll() is not None:
+                            raise RuntimeError("uvicorn exited before answering")
+                        time.sleep(0.005)
+                samples["first_response"].append(time.perf_counter() - start)
+            finally:
+                server.terminate()
+                server.wait()
+    return {name: summarize(times) for name, times in samples.items()}
+
+
+def compare(results, baseline, tolerance):
+    """Operations whose p50 is more than `tolerance` slower than the baseline's."""
+    regressions = []
+    for size, operations in results.items():
+        for name, stats in operations.items():
+            before = baseline.get(str(size), {}).get(name)
+            if before and stats["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{size} tasks {name}: p50 {before['p50_ms']:.2f} ms -> {stats['p50_ms']:.2f} ms"
+                )
+    return regressions
+
+
+def print_table(results):
+    for size, operations in results.items():
+        for name, stats in operations.items():
+            print(f"{size:>8} tasks  {name:<15} "
+                  f"mean {stats['mean_ms']:7.2f} ms  "
+                  f"p50 {stats['p50_ms']:7.2f} ms  "
+                  f"p99 {stats['p99_ms']:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ranks = commands.add_parser("ranks", help="defer/complete/reactivate cost by deck size")
+    ranks.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    ranks.add_argument("--ops", type=int, default=100)
+
+    bulk_import = commands.add_parser("import", help="bulk NDJSON import throughput")
+    bulk_import.add_argument("--size", type=int, default=100000)
+
+    serialize = commands.add_parser("serialize", help="task list serialization paths by deck size")
+    serialize.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    serialize.add_argument("--repeats", type=int, default=10)
+
+    startup = commands.add_parser("startup", help="cold start: import and first response times")
+    startup.add_argument("--repeats", type=int, default=5)
+
+    api = commands.add_parser("api", help="endpoint latency and throughput by deck size")
+    api.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    api.add_argument("--ops", type=int, default=100)
+    api.add_argument("--output", help="write results to this JSON file")
+    api.add_argument("--baseline", help="JSON file from an earlier run to compare against")
+    api.add_argument("--tolerance", type=float, default=0.2, help="allowed p50 slowdown (0.2 = 20%%)")
+
+    args = parser.parse_args()
+    if args.command == "ranks":
+        print_table(bench_ranks(args.sizes, args.ops))
+    elif args.command == "import":
+        print(json.dumps(bench_import(args.size), indent=2))
+    elif args.command == "serialize":
+        print_table(bench_serialize(args.sizes, args.repeats))
+    elif args.command == "startup":
+        for name, stats in bench_startup(args.repeats).items():
+            print(f"{name:<15} mean {stats['mean_ms']:7.1f} ms  p50 {stats['p50_ms']:7.1f} ms")
+    elif args.command == "api":
+        results = bench_api(args.sizes, args.ops)
+        print_table(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({
+                    "environment": {
+                        "python": platform.python_version(),
+                        "sqlite": sqlite3.sqlite_version,
+                        "machine": platform.machine(),
+                        "ops": args.ops,
+                    },
+                    "results": results,
+                }, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(results, json.load(f)["results"], args.tolerance)
+            for line in regressions:
+                print(f"REGRESSION {line}")
+            if regressions:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,34 +8,73 @@ on disk.
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.pool import StaticPool
 
-from main import app, get_db, Base
+from main import app, get_sessionmaker, get_write_sessionmaker, migrate, create_sqlite_engine
 
 
 @pytest.fixture()
-def client():
-    engine = create_engine(
-        "sqlite://",
+def engine():
+    return create_async_engine(
+        "sqlite+aiosqlite://",
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    Base.metadata.create_all(bind=engine)
 
-    def override_get_db():
-        db = TestingSessionLocal()
-        try:
-            yield db
-        finally:
-            db.close()
 
-    app.dependency_overrides[get_db] = override_get_db
+@pytest.fixture()
+def client(engine):
+    TestingSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    app.dependency_overrides[get_sessionmaker] = lambda: TestingSessionLocal
+    app.dependency_overrides[get_write_sessionmaker] = lambda: TestingSessionLocal
     try:
         with TestClient(app) as test_client:
+            # The async engine belongs to the app's event loop, so schema
+            # setup and teardown run through the client's portal.
+            test_client.portal.call(migrate, engine)
             yield test_client
+            test_client.portal.call(engine.dispose)
     finally:
-        app.dependency_overrides.pop(get_db, None)
-        engine.dispose()
+        app.dependency_overrides.pop(get_sessionmaker, None)
+        app.dependency_overrides.pop(get_write_sessionmaker, None)
+
+
+@pytest.fixture()
+def file_client(tmp_path):
+    """A TestClient on a SQLite file with the production profile (WAL,
+    pragmas, a reader pool and one writer). Its engines are on `.engines`."""
+    url = f"sqlite+aiosqlite:///{tmp_path / 'onejob.db'}"
+    readers, writer = create_sqlite_engine(url), create_sqlite_engine(url, writer=True)
+
+    app.dependency_overrides[get_sessionmaker] = lambda: async_sessionmaker(
+        readers, autoflush=False, expire_on_commit=False
+    )
+    app.dependency_overrides[get_write_sessionmaker] = lambda: async_sessionmaker(
+        writer, autoflush=False, expire_on_commit=False
+    )
+    try:
+        with TestClient(app) as test_client:
+            test_client.portal.call(migrate, writer)
+            test_client.engines = (readers, writer)
+            yield test_client
+            test_client.portal.call(readers.dispose)
+            test_client.portal.call(writer.dispose)
+    finally:
+        app.dependency_overrides.pop(get_sessionmaker, None)
+        app.dependency_overrides.pop(get_write_sessionmaker, None)
+
+
+@pytest.fixture()
+def statements(engine):
+    """SQL statements executed against the test database, in order."""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(engine.sync_engine, "before_cursor_execute", record)
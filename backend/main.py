@@ -10,27 +10,88 @@
 #             - This resolves the 'UndefinedColumn' error from PostgreSQL.
 
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import APIRouter, FastAPI, Depends, Header, HTTPException, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any, Optional
-from datetime import datetime, timezone
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.datastructures import Headers
+from typing import Annotated, List, Dict, Any, Literal, Optional, Tuple, Union
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, timezone
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import math
+import random
+import re
+import time
 import uuid
+from urllib.parse import quote
+
+import orjson
 
 # SQLAlchemy Imports
-from sqlalchemy import create_engine, Column, String, Boolean, DateTime, Integer, text, desc, asc, inspect, func
-from sqlalchemy.dialects.postgresql import UUID as PostgreSQLUUID
+from sqlalchemy import String, Boolean, Date, DateTime, Float, Integer, LargeBinary, Text, bindparam, text, delete, func, insert, select, tuple_, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
 import sqlalchemy.types as types
-from sqlalchemy.orm import sessionmaker, Session, Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey
+from sqlalchemy.orm import Mapped, mapped_column, relationship, selectinload
+from sqlalchemy import ForeignKey, Index, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
 
 # Pydantic Settings for environment variables
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import BaseModel, ConfigDict
+from pydantic import AliasChoices, BaseModel, ConfigDict, Field, StringConstraints, ValidationError
+from pydantic.alias_generators import to_camel
 
 # --- Configuration ---
 class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite:///./onejob.db"  # Default to SQLite
+    # Bytes of serialized task reads kept in memory; 0 turns the cache off.
+    # Other workers' writes only reach a process's cache through the
+    # postgres events broker, so with several workers (WEB_CONCURRENCY, which
+    # uvicorn and gunicorn read too) and the local broker it is forced off.
+    RESPONSE_CACHE_BYTES: int = 32 * 1024 * 1024
+    WEB_CONCURRENCY: int = 1
+    # Most responses the cache holds, however small
+    RESPONSE_CACHE_ENTRIES: int = 10_000
+    # Log every request slower than this, with its SQL statements; 0 = off.
+    SLOW_REQUEST_MS: float = 0
+    # Responses at least this big are gzipped for clients that accept it
+    GZIP_MIN_BYTES: int = 1024
+    # Where GET /events streams learn of writes: "local" (this process) or
+    # "postgres" (LISTEN/NOTIFY, shared by every worker on the database)
+    EVENTS_BROKER: Literal["local", "postgres"] = "local"
+    EVENTS_HEARTBEAT_SECONDS: float = 15
+    # How long a write's Idempotency-Key (and its recorded response) is kept
+    IDEMPOTENCY_TTL_SECONDS: int = 24 * 60 * 60
+    # Keyed writes running longer than this are cancelled with 504 and their
+    # key released. A key still in progress after twice this long was
+    # claimed by a process that died, and can be claimed again.
+    IDEMPOTENCY_TIMEOUT_SECONDS: float = 30
+    # Done tasks completed more than this many days ago are moved to the
+    # tasks_archive table, checked every ARCHIVE_INTERVAL_SECONDS; 0 = off.
+    # Off by default: archived tasks drop out of GET /tasks and can't be
+    # updated, and the app doesn't read GET /tasks/archived yet.
+    ARCHIVE_AFTER_DAYS: int = 0
+    ARCHIVE_INTERVAL_SECONDS: float = 10 * 60
+
+    # SQLite profile, applied to file databases on every new connection.
+    # WAL lets readers run alongside the writer; synchronous=NORMAL is
+    # durable across crashes of the app (not of the OS) and is the usual
+    # pairing with WAL.
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE_KB: int = 64 * 1024
+    SQLITE_READ_POOL_SIZE: int = 5
 
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
@@ -41,23 +102,100 @@ settings = Settings()
 if settings.DATABASE_URL.startswith("postgres://"):
     settings.DATABASE_URL = settings.DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+
+def async_database_url(url: str) -> str:
+    """Pick the async driver for a plain sqlite:// or postgresql:// URL.
+
+    URLs that already name a driver (e.g. postgresql+asyncpg://) are left alone.
+    """
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
+
 # --- Database Setup ---
-# Handle SQLite vs PostgreSQL differences
-if settings.DATABASE_URL.startswith("sqlite"):
-    # SQLite needs check_same_thread=False for FastAPI
-    from sqlalchemy.pool import StaticPool
-    engine = create_engine(
-        settings.DATABASE_URL,
+# Routes are async end to end: queries await an async driver (aiosqlite or
+# asyncpg) instead of blocking the event loop, so one worker keeps many
+# requests in flight.
+#
+# Reads and writes get separate engines. On Postgres they are the same
+# engine. A SQLite file gets a pool of reader connections plus a single
+# writer connection that opens every transaction with BEGIN IMMEDIATE, so
+# writes queue for the write lock up front (waiting up to busy_timeout)
+# instead of failing when a read transaction tries to upgrade. In-memory
+# SQLite only exists on one connection, so it keeps a single StaticPool
+# connection for everything.
+#
+# A read session sees one snapshot from its first query to its last, so the
+# queries behind one response (a task page, then its substacks and cards)
+# agree with each other even while writes land: SQLite readers open a
+# deferred BEGIN, and Postgres reads run at REPEATABLE READ.
+
+def sqlite_pragmas() -> List[str]:
+    return [
+        f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}",
+        f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KB}",  # negative = KiB
+    ]
+
+
+def create_sqlite_engine(url: str, writer: bool = False):
+    """An engine on a SQLite file, tuned by the SQLITE_* settings."""
+    sqlite_engine = create_async_engine(
+        url,
         connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
+        # aiosqlite defaults to NullPool (a new connection, and pragma
+        # round, per checkout); keep connections open instead.
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1 if writer else settings.SQLITE_READ_POOL_SIZE,
+        max_overflow=0 if writer else 10,
     )
-else:
-    engine = create_engine(settings.DATABASE_URL)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    @event.listens_for(sqlite_engine.sync_engine, "connect")
+    def configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+        # Take over transaction control from the driver, which would only
+        # begin one before a write (so each SELECT got its own snapshot)
+        # and never with IMMEDIATE.
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(sqlite_engine.sync_engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE" if writer else "BEGIN")
+
+    return sqlite_engine
+
+
+def is_sqlite_memory(url: str) -> bool:
+    return url.rstrip("/") in ("sqlite:", "sqlite+aiosqlite:") or ":memory:" in url or "mode=memory" in url
+
+
+def create_engines(url: str) -> Tuple[AsyncEngine, AsyncEngine]:
+    """The (read, write) engines for an async database URL. Nothing connects
+    until the first query."""
+    if is_sqlite_memory(url):
+        engine = create_async_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        return engine, engine
+    if url.startswith("sqlite"):
+        return create_sqlite_engine(url), create_sqlite_engine(url, writer=True)
+    engine = create_async_engine(url)
+    return engine.execution_options(isolation_level="REPEATABLE READ"), engine
 
 Base = declarative_base()
 
+DEFAULT_DECK = "default"
+
 # Custom UUID type that works with both SQLite and PostgreSQL
 class UUID(types.TypeDecorator):
     """Platform-independent UUID type"""
@@ -66,6 +204,7 @@ class UUID(types.TypeDecorator):
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import UUID as PostgreSQLUUID
             return dialect.type_descriptor(PostgreSQLUUID(as_uuid=True))
         else:
             return dialect.type_descriptor(types.String(36))
@@ -95,8 +234,20 @@ class UUID(types.TypeDecorator):
 # SQLAlchemy Model
 class DBTask(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # GET /tasks reads each pile of a deck straight off one of these,
+        # already in display order: todo by sort_order, done by most recent
+        # completion. Leading with deck_id keeps every lookup (including the
+        # min/max rank lookups) within the caller's own deck.
+        Index("ix_tasks_deck_id_status_sort_order", "deck_id", "status", "sort_order", "id"),
+        Index("ix_tasks_deck_id_status_completed_at", "deck_id", "status", "completed_at", "id"),
+        # The most-deferred tasks for GET /stats, read off the top
+        Index("ix_tasks_deck_id_deferral_count", "deck_id", "deferral_count", "id"),
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(), primary_key=True, default=uuid.uuid4)
+    # The deck (owner) the task belongs to, from the X-Deck-Id header
+    deck_id: Mapped[str] = mapped_column(String, default=DEFAULT_DECK, server_default=DEFAULT_DECK)
     title: Mapped[str] = mapped_column(String, index=True)
     description: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     
@@ -115,11 +266,21 @@ class DBTask(Base):
     source: Mapped[Optional[str]] = mapped_column(String, nullable=True) # e.g., "linear", "jira"
     
     # Relationship to substacks
-    substacks = relationship("DBSubstack", back_populates="parent_task", cascade="all, delete-orphan")
+    substacks = relationship(
+        "DBSubstack",
+        back_populates="parent_task",
+        cascade="all, delete-orphan",
+        order_by="DBSubstack.created_at",
+    )
 
 
 class DBSubstack(Base):
     __tablename__ = "substacks"
+    __table_args__ = (
+        # Children are always loaded by parent, in display order; without
+        # these every task read scans the whole child table.
+        Index("ix_substacks_parent_task_id_created_at", "parent_task_id", "created_at"),
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(), primary_key=True, default=uuid.uuid4)
     name: Mapped[str] = mapped_column(String, index=True)
@@ -128,11 +289,19 @@ class DBSubstack(Base):
     
     # Relationships
     parent_task = relationship("DBTask", back_populates="substacks")
-    tasks = relationship("DBSubstackTask", back_populates="substack", cascade="all, delete-orphan")
+    tasks = relationship(
+        "DBSubstackTask",
+        back_populates="substack",
+        cascade="all, delete-orphan",
+        order_by="DBSubstackTask.sort_order",
+    )
 
 
 class DBSubstackTask(Base):
     __tablename__ = "substack_tasks"
+    __table_args__ = (
+        Index("ix_substack_tasks_substack_id_sort_order", "substack_id", "sort_order"),
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(), primary_key=True, default=uuid.uuid4)
     title: Mapped[str] = mapped_column(String, index=True)
@@ -147,13 +316,501 @@ class DBSubstackTask(Base):
     substack = relationship("DBSubstack", back_populates="tasks")
 
 
-# Dependency to get the DB session
-def get_db():
-    db = SessionLocal()
-    try:
+class DBArchivedTask(Base):
+    """A done task moved out of `tasks` by the archiver, substacks and all."""
+    __tablename__ = "tasks_archive"
+    __table_args__ = (
+        Index("ix_tasks_archive_deck_id_completed_at", "deck_id", "completed_at", "id"),
+    )
+
+    id: Mapped[uuid.UUID] = mapped_column(UUID(), primary_key=True)
+    deck_id: Mapped[str] = mapped_column(String)
+    completed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    archived_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    # The task as it was last served by GET /tasks (TaskResponse JSON)
+    document: Mapped[str] = mapped_column(Text)
+
+
+class DBDailyStats(Base):
+    """Per-deck counts of task transitions on each (UTC) day, for GET /stats."""
+    __tablename__ = "daily_stats"
+
+    deck_id: Mapped[str] = mapped_column(String, primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    completed: Mapped[int] = mapped_column(Integer, default=0)
+    deferred: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class DBDoneDuration(Base):
+    """How many of a day's completions took how long, by histogram bucket."""
+    __tablename__ = "done_durations"
+
+    deck_id: Mapped[str] = mapped_column(String, primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    bucket: Mapped[str] = mapped_column(String, primary_key=True) # a TIME_TO_DONE_BUCKETS label
+    count: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class DBDoneTime(Base):
+    """How many of a day's completions took how long, to two significant
+    figures: fine enough for the median, yet a few hundred rows a day at most."""
+    __tablename__ = "done_times"
+
+    deck_id: Mapped[str] = mapped_column(String, primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    seconds: Mapped[int] = mapped_column(Integer, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class DBDeckState(Base):
+    """Per-deck bookkeeping, one row per deck that has been written to."""
+    __tablename__ = "deck_state"
+
+    deck_id: Mapped[str] = mapped_column(String, primary_key=True, default=DEFAULT_DECK)
+    # Bumped in the same transaction as every write to the deck's tasks,
+    # substacks or substack tasks; clients see it as the ETag of task reads.
+    version: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class DBChange(Base):
+    """Append-only log of which rows each deck version touched (for /changes)."""
+    __tablename__ = "changes"
+    __table_args__ = (
+        Index("ix_changes_deck_id_version", "deck_id", "version"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    deck_id: Mapped[str] = mapped_column(String, default=DEFAULT_DECK)
+    version: Mapped[int] = mapped_column(Integer)
+    entity: Mapped[str] = mapped_column(String) # a table name: tasks, substacks or substack_tasks
+    entity_id: Mapped[uuid.UUID] = mapped_column(UUID())
+
+
+class DBIdempotencyKey(Base):
+    """The response of a write sent with an Idempotency-Key, for replaying retries."""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("ix_idempotency_keys_created_at", "created_at"),
+    )
+
+    deck_id: Mapped[str] = mapped_column(String, primary_key=True)
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    method: Mapped[str] = mapped_column(String)
+    path: Mapped[str] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    # All null while the first request is still running
+    status_code: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    headers: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON [[name, value], ...]
+    body: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+
+
+# Dependencies to get the DB session: get_db for reads, get_write_db for
+# anything that writes. Streaming responses outlive their route's
+# dependencies, so they open sessions from get_sessionmaker directly. The
+# sessionmakers are created by the app's lifespan (see create_app).
+def get_sessionmaker(request: Request) -> async_sessionmaker:
+    return request.app.state.sessions
+
+
+def get_write_sessionmaker(request: Request) -> async_sessionmaker:
+    return request.app.state.write_sessions
+
+
+def app_sessions(app: FastAPI, write: bool = False) -> async_sessionmaker:
+    """The sessionmaker routes get, for code outside a request (middleware,
+    background jobs); dependency overrides included."""
+    dependency = get_write_sessionmaker if write else get_sessionmaker
+    if dependency in app.dependency_overrides:
+        return app.dependency_overrides[dependency]()
+    return app.state.write_sessions if write else app.state.sessions
+
+
+def get_deck_id(
+    deck_id: str = Header(DEFAULT_DECK, alias="X-Deck-Id", min_length=1, max_length=64),
+) -> str:
+    """The deck a request acts on. Clients that don't send one share "default"."""
+    return deck_id
+
+
+async def get_db(
+    deck_id: str = Depends(get_deck_id),
+    sessions: async_sessionmaker = Depends(get_sessionmaker),
+):
+    # The session carries its deck, so every query helper below scopes
+    # itself to the caller's deck without it being passed around.
+    async with sessions(info={"deck_id": deck_id}) as db:
         yield db
-    finally:
-        db.close()
+
+
+async def get_write_db(
+    deck_id: str = Depends(get_deck_id),
+    sessions: async_sessionmaker = Depends(get_write_sessionmaker),
+):
+    async with sessions(info={"deck_id": deck_id}) as db:
+        yield db
+
+
+def deck_of(db: AsyncSession) -> str:
+    return db.info.get("deck_id", DEFAULT_DECK)
+
+
+# Async sessions can't lazy-load relationships, so anything that feeds a
+# response model loads its substack tree up front. selectinload fetches each
+# level with one IN query, so a task query costs three queries no matter
+# how many tasks or substacks it holds.
+TASK_TREE = selectinload(DBTask.substacks).selectinload(DBSubstack.tasks)
+
+
+async def get_task_tree(db: AsyncSession, task_id: uuid.UUID) -> Optional[DBTask]:
+    result = await db.execute(
+        select(DBTask)
+        .options(TASK_TREE)
+        .where(DBTask.id == task_id)
+        .execution_options(populate_existing=True)
+    )
+    return result.scalar_one_or_none()
+
+
+async def get_substack_tree(db: AsyncSession, substack_id: uuid.UUID) -> Optional[DBSubstack]:
+    result = await db.execute(
+        select(DBSubstack)
+        .options(selectinload(DBSubstack.tasks))
+        .where(DBSubstack.id == substack_id)
+        .execution_options(populate_existing=True)
+    )
+    return result.scalar_one_or_none()
+
+
+# Indexes replaced by newer ones, dropped from existing databases
+RETIRED_INDEXES = ["ix_tasks_status_sort_order", "ix_tasks_status_completed_at"]
+
+
+def _create_tables_and_indexes(connection) -> None:
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateColumn
+
+    Base.metadata.create_all(connection)
+    # create_all neither alters existing tables nor indexes them. Columns
+    # added to a model since (which must carry a server_default) and new
+    # indexes are created explicitly.
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+    for name in RETIRED_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    create_search_index(connection)
+
+
+# --- Migrations ---
+# The schema is brought up to date by an explicit step, run once per deploy
+# (`python main.py migrate`; on Render, the build command), not on every
+# boot, so a cold start does no DDL or schema introspection. The database
+# records each migration applied in schema_migrations, and migrate() runs
+# the ones it hasn't had, in order, in one transaction.
+#
+# Migration 1 takes any database (empty, or created by the create-on-boot
+# releases before versioning) to the models as they stand. Append a
+# migration for each later schema change; one that only adds tables,
+# columns (with a server_default) or indexes to the models can simply be
+# _create_tables_and_indexes again.
+def _repair_task_statuses(connection) -> None:
+    # Task updates used to accept any status, which could leave tasks in
+    # neither pile, or done without a completed_at (or todo without a
+    # sort_order), which the keyset-paginated piles skip. Such tasks go back
+    # to todo at the bottom of their deck, or count as done when created.
+    connection.execute(
+        update(DBTask)
+        .where(DBTask.status.not_in(["todo", "done"]))
+        .values(status="todo", completed=False, completed_at=None)
+    )
+    connection.execute(
+        update(DBTask)
+        .where(DBTask.status == "done", DBTask.completed_at.is_(None))
+        .values(completed_at=func.coalesce(DBTask.created_at, func.current_timestamp()))
+    )
+    todo = DBTask.__table__.alias("todo")
+    bottom = (
+        select(func.coalesce(func.max(todo.c.sort_order), 0) + 1)
+        .where(todo.c.deck_id == DBTask.deck_id, todo.c.status == "todo")
+        .scalar_subquery()
+    )
+    connection.execute(
+        update(DBTask)
+        .where(DBTask.status == "todo", DBTask.sort_order.is_(None))
+        .values(sort_order=bottom)
+    )
+
+
+def _tally_existing_tasks(connection) -> "RollupTally":
+    # Each completion counts on its completed_at day, timed from created_at.
+    # Tasks keep only their last deferral time, so a todo task's
+    # deferral_count all counts on its deferred_at day, and done tasks'
+    # deferrals (whose deferred_at is cleared on completion) not at all.
+    tally = RollupTally()
+    tasks = connection.execute(
+        select(DBTask.deck_id, DBTask.created_at, DBTask.completed_at, DBTask.deferred_at, DBTask.deferral_count)
+        .execution_options(yield_per=1000)
+    )
+    for task in tasks:
+        if task.completed_at is not None:
+            tally.count(
+                task.deck_id, task.completed_at, completed=1,
+                time_to_done=as_utc(task.completed_at) - as_utc(task.created_at),
+            )
+        elif task.deferred_at is not None and task.deferral_count:
+            tally.count(task.deck_id, task.deferred_at, deferred=task.deferral_count)
+    archived = connection.execute(
+        select(DBArchivedTask.deck_id, DBArchivedTask.completed_at, DBArchivedTask.document)
+        .execution_options(yield_per=1000)
+    )
+    for task in archived:
+        created_at = TaskResponse.model_validate_json(task.document).created_at
+        tally.count(
+            task.deck_id, task.completed_at, completed=1,
+            time_to_done=as_utc(task.completed_at) - as_utc(created_at),
+        )
+    return tally
+
+
+def _backfill_stats(connection) -> None:
+    # The rollups behind GET /stats only count transitions made since they
+    # were added. Earlier history is rebuilt from the tasks (and archive).
+    # Days a deck already has rollups for are left alone.
+    rolled_up = dict(connection.execute(
+        select(DBDailyStats.deck_id, func.min(DBDailyStats.day)).group_by(DBDailyStats.deck_id)
+    ).all())
+    tally = _tally_existing_tasks(connection)
+
+    def before_rollups(row: Dict[str, Any]) -> bool:
+        return row["deck_id"] not in rolled_up or row["day"] < rolled_up[row["deck_id"]]
+
+    day_rows = [row for row in tally.day_rows() if before_rollups(row)]
+    duration_rows = [row for row in tally.duration_rows() if before_rollups(row)]
+    if day_rows:
+        connection.execute(insert(DBDailyStats), day_rows)
+    if duration_rows:
+        connection.execute(insert(DBDoneDuration), duration_rows)
+
+
+def _backfill_done_times(connection) -> None:
+    # done_times (for the median time to done) starts out with every
+    # completion the tasks and archive still record
+    _create_tables_and_indexes(connection)
+    time_rows = _tally_existing_tasks(connection).time_rows()
+    if time_rows:
+        connection.execute(insert(DBDoneTime), time_rows)
+
+
+MIGRATIONS = [
+    _create_tables_and_indexes,
+    _repair_task_statuses,
+    _backfill_stats,
+    _backfill_done_times,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class DBSchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    applied_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+
+def schema_version(connection) -> int:
+    from sqlalchemy import inspect
+
+    if not inspect(connection).has_table(DBSchemaMigration.__tablename__):
+        return 0
+    return connection.execute(select(func.max(DBSchemaMigration.version))).scalar() or 0
+
+
+def _migrate(connection) -> int:
+    current = schema_version(connection)
+    for version in range(current + 1, SCHEMA_VERSION + 1):
+        MIGRATIONS[version - 1](connection)
+        connection.execute(insert(DBSchemaMigration).values(
+            version=version, applied_at=datetime.now(timezone.utc),
+        ))
+    return SCHEMA_VERSION
+
+
+async def migrate(bind: AsyncEngine) -> int:
+    """Apply any migrations the database hasn't had; returns its version."""
+    async with bind.begin() as conn:
+        return await conn.run_sync(_migrate)
+
+
+def record_change(db: AsyncSession, row: Base) -> None:
+    """Note a task, substack or substack task written by the current request."""
+    db.info.setdefault("changed_rows", []).append(row)
+
+
+async def dialect_insert(db: AsyncSession, model: Base):
+    """An INSERT for `model` that supports on_conflict_do_update (an upsert)."""
+    # Only the dialect in use is imported
+    if (await db.connection()).dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    return upsert(model)
+
+
+async def bump_version(db: AsyncSession) -> int:
+    """Advance the deck version inside the current transaction.
+
+    One upsert, so the first writes to a new deck can't race to create its
+    row. It leaves the deck's row locked until the transaction ends.
+    """
+    upsert = await dialect_insert(db, DBDeckState)
+    return (await db.execute(
+        upsert.values(deck_id=deck_of(db), version=1)
+        .on_conflict_do_update(
+            index_elements=[DBDeckState.deck_id],
+            set_={"version": DBDeckState.version + 1},
+        )
+        .returning(DBDeckState.version)
+    )).scalar_one()
+
+
+async def lock_deck(db: AsyncSession) -> int:
+    """Take the deck's write lock for this transaction; returns the version
+    the transaction will commit as.
+
+    Every write to a deck calls this before touching anything else, so
+    writers to the same deck queue on its deck_state row, in every process
+    and always in the same lock order. Under that lock the rank lookups in
+    next_sort_order/top_sort_order can't hand two tasks the same position.
+    (SQLite already serializes writers with BEGIN IMMEDIATE; this is what
+    makes the same guarantee hold on Postgres.)
+    """
+    if "version" not in db.info:
+        db.info["version"] = await bump_version(db)
+    return db.info["version"]
+
+
+async def commit_changes(db: AsyncSession) -> int:
+    """Commit a write, bumping the deck version in the same transaction.
+
+    Rows passed to record_change() are logged against the new version, which
+    is returned. The caller publishes it (publish_version) once the write
+    can no longer be rolled back or rerun.
+    """
+    # Flush first so new rows have their ids
+    await db.flush()
+    version = await lock_deck(db)
+
+    logged = set()
+    for row in db.info.pop("changed_rows", []):
+        key = (row.__tablename__, row.id)
+        if key not in logged:
+            logged.add(key)
+            db.add(DBChange(deck_id=deck_of(db), version=version, entity=row.__tablename__, entity_id=row.id))
+    await commit_write(db)
+    db.info.pop("version")
+    response_cache.invalidate(deck_of(db))
+    return version
+
+
+async def publish_version(db: AsyncSession, version: int) -> None:
+    """Tell /events streams about a committed write.
+
+    The write has committed by now, so a broker failure (say a failed
+    NOTIFY) must not fail the request: it is logged, and streams catch up
+    at the next write or reconnect.
+    """
+    try:
+        await event_broker.publish(db, deck_of(db), version)
+    except Exception:
+        logger.exception("Publishing version %d of deck %s failed", version, deck_of(db))
+        await db.rollback()
+
+
+# Postgres serialization failures and deadlocks, and SQLite's write lock
+# staying busy past busy_timeout, abort a transaction that would succeed if
+# simply run again.
+WRITE_ATTEMPTS = 3
+
+
+def is_write_conflict(exc: DBAPIError) -> bool:
+    return (
+        getattr(exc.orig, "sqlstate", None) in ("40001", "40P01")
+        or "database is locked" in str(exc.orig)
+    )
+
+
+async def run_write(db: AsyncSession, write):
+    """Run `write` (a coroutine function making one request's changes) and
+    commit it, rerunning the whole transaction after a write conflict.
+
+    Returns what `write` returned. Any failure rolls the transaction back.
+    """
+    for attempt in range(WRITE_ATTEMPTS):
+        try:
+            result = await write()
+            version = await commit_changes(db)
+            break
+        except Exception as exc:
+            await db.rollback()
+            db.info.pop("version", None)
+            db.info.pop("changed_rows", None)
+            if not isinstance(exc, DBAPIError) or not is_write_conflict(exc) or attempt == WRITE_ATTEMPTS - 1:
+                raise
+        await asyncio.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    await publish_version(db, version)
+    return result
+
+
+async def deck_version(db: AsyncSession) -> int:
+    version = (await db.execute(
+        select(DBDeckState.version).where(DBDeckState.deck_id == deck_of(db))
+    )).scalar()
+    return version or 0
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in tags or "*" in tags
+
+
+# Task reads differ by deck, which browsers and shared caches must key on
+DECK_VARY = {"Vary": "X-Deck-Id"}
+
+
+def deck_etag(deck_id: str, version: int) -> str:
+    # Versions count per deck, so the tag names the deck too: another deck's
+    # tag at the same version must not match. Quoted so the tag stays a
+    # valid (comma- and quote-free) entity tag.
+    return f'"{quote(deck_id, safe="")}:{version}"'
+
+
+async def not_modified(request: Request, response: Response, db: AsyncSession) -> Optional[Response]:
+    """Tag a task read with the deck and its version; a 304 if the client is current.
+
+    The version is read before the tasks, so a write landing in between can
+    only make the ETag older than the body (costing one extra refetch), never
+    newer.
+    """
+    etag = deck_etag(deck_of(db), await deck_version(db))
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, **DECK_VARY})
+    response.headers["ETag"] = etag
+    response.headers.update(DECK_VARY)
+    # Cacheable, but revalidate every time; browsers then send If-None-Match
+    # on their own.
+    response.headers["Cache-Control"] = "no-cache"
+    return None
+
 
 # Pydantic Models for request/response
 class TaskBase(BaseModel):
@@ -166,7 +823,7 @@ class TaskCreate(TaskBase):
 class TaskUpdate(BaseModel):
     title: Optional[str] = None
     description: Optional[str] = None
-    status: Optional[str] = None # Will only be "todo" or "done" now
+    status: Optional[Literal["todo", "done"]] = None
     is_deferral: Optional[bool] = None
 
     model_config = ConfigDict(extra='ignore')
@@ -220,43 +877,644 @@ class TaskResponse(TaskBase):
     model_config = ConfigDict(from_attributes=True)
 
 
-# --- API Endpoints ---
-app = FastAPI()
+class SearchResult(BaseModel):
+    kind: Literal["task", "substack_task"]
+    id: uuid.UUID
+    task_id: uuid.UUID # the deck card the match is on (its own id for a task)
+    title: str
+    description: Optional[str] = None
+    completed: bool
+    score: float # higher is a better match
 
-# CORS configuration to allow frontend to communicate with backend
-origins = [
-    "http://localhost:8080",  # Frontend URL
-    "http://127.0.0.1:8080",  # Alternative frontend URL
-    "http://localhost:5173",  # Vite default port
-    "http://localhost:4173",  # Vite preview
-    "http://127.0.0.1:4173",  # Vite preview
-    "https://onejob.co",      # Production domain
-    "https://www.onejob.co",  # Production www domain
-    "https://design-in-product.github.io",  # GitHub Pages domain
+
+class DayStats(BaseModel):
+    day: date
+    completed: int
+    deferred: int
+
+
+class DeferredTaskStats(BaseModel):
+    id: uuid.UUID
+    title: str
+    status: str
+    deferral_count: int
+
+
+class TimeToDoneStats(BaseModel):
+    # Median time from creation to done, to two significant figures; None
+    # before any completion
+    median_seconds: Optional[float] = None
+    median_bucket: Optional[str] = None # the bucket holding the median
+    buckets: Dict[str, int] # completions by how long they took, smallest bucket first
+
+
+class StatsResponse(BaseModel):
+    days: List[DayStats] # oldest first, ending today
+    completed: int
+    deferred: int
+    most_deferred: List[DeferredTaskStats]
+    time_to_done: TimeToDoneStats
+
+
+class ChangesResponse(BaseModel):
+    cursor: int # pass back as `since` on the next sync
+    tasks: List[TaskResponse] = []
+    substacks: List[SubstackResponse] = []
+    substack_tasks: List[SubstackTaskResponse] = []
+    # Tasks moved to the archive since `since`, substacks and all; no longer
+    # in GET /tasks, so clients drop them
+    archived_task_ids: List[uuid.UUID] = []
+
+
+# Batch operations. Ids can be given directly or as "$n", the row created or
+# changed by operation n earlier in the same batch.
+MAX_BATCH_SIZE = 100
+BatchRef = Union[uuid.UUID, Annotated[str, StringConstraints(pattern=r"^\$\d+$")]]
+
+
+class BatchCreateTask(TaskCreate):
+    op: Literal["create_task"]
+
+class BatchDeferTask(BaseModel):
+    op: Literal["defer_task"]
+    task_id: BatchRef
+
+class BatchCompleteTask(BaseModel):
+    op: Literal["complete_task"]
+    task_id: BatchRef
+
+class BatchCreateSubstack(SubstackCreate):
+    op: Literal["create_substack"]
+    task_id: BatchRef
+
+class BatchAddSubstackTask(SubstackTaskCreate):
+    op: Literal["add_substack_task"]
+    substack_id: BatchRef
+
+class BatchCompleteSubstackTask(BaseModel):
+    op: Literal["complete_substack_task"]
+    task_id: BatchRef
+
+BatchOperation = Annotated[
+    Union[
+        BatchCreateTask,
+        BatchDeferTask,
+        BatchCompleteTask,
+        BatchCreateSubstack,
+        BatchAddSubstackTask,
+        BatchCompleteSubstackTask,
+    ],
+    Field(discriminator="op"),
 ]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Create tables on startup
-Base.metadata.create_all(bind=engine)
-
-@app.post("/tasks", response_model=TaskResponse, status_code=status.HTTP_201_CREATED)
-async def create_task(task: TaskCreate, db: Session = Depends(get_db)):
-    # Find the maximum sort_order for existing active tasks
-    # Active tasks are those with status 'todo'
-    max_order_result = db.query(func.max(DBTask.sort_order)).filter(
-        DBTask.status == "todo"
-    ).scalar()
 
-    new_sort_order = (max_order_result or 0) + 1
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class BatchResponse(ChangesResponse):
+    ids: List[uuid.UUID] # the row each operation created or changed, in order
+
+
+# Imports accept both the API's own task shape (snake_case, `substacks` of
+# `tasks`, as GET /tasks returns) and the app's backup cards (camelCase,
+# `decks` of `cards`).
+class ImportModel(BaseModel):
+    model_config = ConfigDict(alias_generator=to_camel, populate_by_name=True, extra="ignore")
+
+class ImportSubstackTask(ImportModel):
+    title: str
+    description: Optional[str] = None
+    completed: bool = False
+    created_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+
+class ImportSubstack(ImportModel):
+    name: Optional[str] = None
+    created_at: Optional[datetime] = None
+    tasks: List[ImportSubstackTask] = Field(default=[], validation_alias=AliasChoices("tasks", "cards"))
+
+class ImportTask(ImportModel):
+    title: str
+    description: Optional[str] = None
+    completed: bool = False
+    status: Optional[str] = None
+    created_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+    deferred_at: Optional[datetime] = None
+    deferral_count: int = 0
+    external_id: Optional[str] = None
+    source: Optional[str] = None
+    trashed_at: Optional[datetime] = None
+    substacks: List[ImportSubstack] = Field(default=[], validation_alias=AliasChoices("substacks", "decks"))
+
+class ImportResponse(BaseModel):
+    tasks: int
+    substacks: int
+    substack_tasks: int
+    cursor: int
+
+
+# --- Pagination ---
+# /tasks pages are keyset-paginated: each view (todo or done) is walked along
+# its own index, and a cursor is the sort key of the last task returned plus
+# its id. Cursors are opaque to clients.
+TaskStatus = Literal["todo", "done"]
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(view: str, task: Dict[str, Any]) -> str:
+    if view == "todo":
+        key = task["sort_order"]
+    elif view == "search":
+        key = task["score"]
+    else:
+        key = task["completed_at"].isoformat()
+    raw = json.dumps([view, key, str(task["id"])]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(view: str, cursor: str) -> Tuple[Any, uuid.UUID]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_view, key, task_id = json.loads(base64.urlsafe_b64decode(padded))
+        if cursor_view != view:
+            raise ValueError("cursor belongs to another view")
+        # Keys the database could not compare against (too big for a
+        # 64-bit integer, or not a finite number) are as invalid as garbage
+        if view == "todo":
+            key = int(key)
+            if not -2**63 <= key < 2**63:
+                raise ValueError("cursor key out of range")
+        elif view == "search":
+            key = float(key)
+            if not math.isfinite(key):
+                raise ValueError("cursor key out of range")
+        else:
+            key = datetime.fromisoformat(key)
+        return key, uuid.UUID(task_id)
+    except (binascii.Error, OverflowError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def task_view_query(deck_id: str, view: str, cursor: Optional[str] = None):
+    """A deck's tasks in one pile, in display order, starting after `cursor`."""
+    query = select(DBTask).where(DBTask.deck_id == deck_id, DBTask.status == view)
+    if view == "todo":
+        query = query.order_by(DBTask.sort_order, DBTask.id)
+        if cursor is not None:
+            query = query.where(tuple_(DBTask.sort_order, DBTask.id) > decode_cursor(view, cursor))
+    else:
+        query = query.order_by(DBTask.completed_at.desc(), DBTask.id.desc())
+        if cursor is not None:
+            query = query.where(tuple_(DBTask.completed_at, DBTask.id) < decode_cursor(view, cursor))
+    return query
+
+
+# --- Read path ---
+# Task reads are the hot path, so they skip the ORM and Pydantic: a task
+# query's columns, its substacks and their cards are fetched as plain rows
+# (three queries, no identity map), assembled into dicts in the TaskResponse
+# wire shape and encoded by orjson. TaskResponse still documents the shape.
+TASK_COLUMNS = [
+    DBTask.title, DBTask.description, DBTask.id, DBTask.completed, DBTask.status,
+    DBTask.created_at, DBTask.completed_at, DBTask.deferred_at, DBTask.deferral_count,
+    DBTask.sort_order, DBTask.external_id, DBTask.source,
+]
+TASK_FIELDS = {column.key: column for column in TASK_COLUMNS}
+SUBSTACK_COLUMNS = [DBSubstack.name, DBSubstack.id, DBSubstack.parent_task_id, DBSubstack.created_at]
+SUBSTACK_TASK_COLUMNS = [
+    DBSubstackTask.title, DBSubstackTask.description, DBSubstackTask.id, DBSubstackTask.completed,
+    DBSubstackTask.created_at, DBSubstackTask.completed_at, DBSubstackTask.sort_order,
+    DBSubstackTask.substack_id,
+]
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """The task fields named by a `fields=` parameter; None means all of them."""
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in TASK_FIELDS]
+    if not names or unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown) or fields!r}")
+    return names
+
+
+async def read_tasks(
+    db: AsyncSession,
+    query,
+    fields: Optional[List[str]] = None,
+    substacks: bool = True,
+) -> List[Dict[str, Any]]:
+    """Run a task query (e.g. from task_view_query) into response dicts, in
+    query order.
+
+    Only the columns in `fields` (plus id) are selected, all of them if it
+    is None; the substack trees are only fetched if `substacks` is set.
+    """
+    columns = TASK_COLUMNS if fields is None else [TASK_FIELDS[name] for name in dict.fromkeys(["id", *fields])]
+    rows = (await db.execute(query.with_only_columns(*columns))).all()
+    if not rows or not substacks:
+        return [row._asdict() for row in rows]
+    tasks = {row.id: {**row._asdict(), "substacks": []} for row in rows}
+
+    # The children are selected by re-running the task query as a subquery,
+    # which keeps the parameter count fixed however many tasks there are.
+    # The read session's snapshot (see create_engines) makes the rerun see
+    # the same tasks as the first query.
+    task_ids = query.with_only_columns(DBTask.id)
+    substack_ids = select(DBSubstack.id).where(DBSubstack.parent_task_id.in_(task_ids))
+    substacks = {}
+    for row in (await db.execute(
+        select(*SUBSTACK_COLUMNS)
+        .where(DBSubstack.parent_task_id.in_(task_ids))
+        .order_by(DBSubstack.created_at)
+    )).all():
+        substack = substacks[row.id] = {**row._asdict(), "tasks": []}
+        tasks[row.parent_task_id]["substacks"].append(substack)
+    for row in (await db.execute(
+        select(*SUBSTACK_TASK_COLUMNS)
+        .where(DBSubstackTask.substack_id.in_(substack_ids))
+        .order_by(DBSubstackTask.sort_order)
+    )).all():
+        card = row._asdict()
+        substacks[card.pop("substack_id")]["tasks"].append(card)
+
+    return list(tasks.values())
+
+
+def json_response(content: Any, response: Response) -> Response:
+    """Encode with orjson, keeping headers already set on the route's response."""
+    return Response(
+        content=orjson.dumps(content, option=orjson.OPT_UTC_Z),
+        media_type="application/json",
+        headers=dict(response.headers),
+    )
+
+
+# --- Response cache ---
+class ResponseCache:
+    """LRU cache of serialized task reads, bounded by size and entry count.
+
+    Keyed by deck, path and query string. A committed write invalidates its
+    deck's entries by moving the deck to a new generation; entries from an
+    older generation are dropped when next looked up, or aged out by the
+    LRU. A read that started before a write must not store what it read
+    afterwards, so entries are only stored if their deck's generation is
+    still the one the read began in.
+
+    An entry's size counts its key and headers as well as its body, plus
+    ENTRY_OVERHEAD for the Python objects holding them, so many small
+    responses cannot outgrow the budget.
+    """
+
+    # Measured cost of an entry's tuples, header dict and LRU link, in bytes
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, max_bytes: int, max_entries: int = 10_000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[bytes, Dict[str, str], int, int]]" = OrderedDict()
+        self.size = 0
+        # Generations come from one clock; `floor` is where invalidate()
+        # without a deck moved every deck to.
+        self.clock = 0
+        self.floor = 0
+        self.generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(deck_id: str, request: Request) -> Tuple[str, str]:
+        return deck_id, f"{request.url.path}?{sorted(request.query_params.multi_items())}"
+
+    @classmethod
+    def cost(cls, key: Tuple[str, str], body: bytes, headers: Dict[str, str]) -> int:
+        return (
+            cls.ENTRY_OVERHEAD
+            + len(key[0]) + len(key[1])
+            + sum(len(name) + len(value) for name, value in headers.items())
+            + len(body)
+        )
+
+    def generation(self, deck_id: str) -> int:
+        return max(self.generations.get(deck_id, 0), self.floor)
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        self.size -= self.entries.pop(key)[3]
+
+    def get(self, key: Tuple[str, str]) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] != self.generation(key[0]):
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, key: Tuple[str, str], body: bytes, headers: Dict[str, str], generation: int) -> None:
+        cost = self.cost(key, body, headers)
+        if generation != self.generation(key[0]) or cost > self.max_bytes or self.max_entries < 1:
+            return
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (body, headers, generation, cost)
+        self.size += cost
+        while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted[3]
+            self.evictions += 1
+
+    def invalidate(self, deck_id: Optional[str] = None) -> None:
+        """Invalidate one deck's entries, or (with no deck) everything."""
+        self.clock += 1
+        if deck_id is not None:
+            self.generations[deck_id] = self.clock
+            # One generation per deck ever written would grow without bound.
+            # Forgetting a deck's generation could let a read that raced its
+            # write store stale data, so instead move every deck to a new
+            # floor, which drops the lot.
+            if len(self.generations) <= self.max_entries:
+                return
+        self.floor = self.clock
+        self.generations.clear()
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def response_cache_bytes() -> int:
+    """RESPONSE_CACHE_BYTES, unless other workers' writes can't reach this
+    process's cache to invalidate it."""
+    if settings.WEB_CONCURRENCY > 1 and settings.EVENTS_BROKER != "postgres":
+        return 0
+    return settings.RESPONSE_CACHE_BYTES
+
+
+response_cache = ResponseCache(response_cache_bytes(), settings.RESPONSE_CACHE_ENTRIES)
+
+
+def cached_read(request: Request, deck_id: str) -> Optional[Response]:
+    """Answer a task read from the cache (a 304 if the client is current)."""
+    entry = response_cache.get(ResponseCache.key(deck_id, request))
+    if entry is None:
+        return None
+    body, headers = entry
+    # Starlette stores header names lower-cased
+    if etag_matches(request, headers["etag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": headers["etag"], **DECK_VARY})
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def cache_read(request: Request, deck_id: str, response: Response, generation: int) -> Response:
+    """Store a freshly built task read and return it."""
+    response_cache.put(ResponseCache.key(deck_id, request), response.body, dict(response.headers), generation)
+    return response
+
+
+# --- Deck order ---
+# sort_order is a sparse rank, not a dense 1..n position: only relative order
+# matters. Cards only ever join the deck at the bottom (create, defer) or the
+# top (reactivate), so a move is a single indexed min/max lookup plus a write
+# to the moved row, and the rest of the deck is never renumbered. Gaps left
+# by completed cards are harmless, and the top can go to zero or below. This
+# matches the frontend's nextSortOrder/topSortOrder in src/domain/tasks.ts.
+
+async def next_sort_order(db: AsyncSession) -> int:
+    """The sort_order a task must take to sit at the bottom of the todo pile."""
+    max_order = (await db.execute(
+        select(func.max(DBTask.sort_order)).where(DBTask.deck_id == deck_of(db), DBTask.status == "todo")
+    )).scalar()
+    return max_order + 1 if max_order is not None else 1
+
+
+async def top_sort_order(db: AsyncSession) -> int:
+    """The sort_order a task must take to sit on top of the todo pile."""
+    min_order = (await db.execute(
+        select(func.min(DBTask.sort_order)).where(DBTask.deck_id == deck_of(db), DBTask.status == "todo")
+    )).scalar()
+    return min_order - 1 if min_order is not None else 1
+
+
+# --- Stats ---
+# GET /stats is served from rollups instead of the tasks table: every
+# deferral and completion adds to its deck's row for the day in daily_stats,
+# and a completion also counts how long the task took (created to done) in
+# a done_durations bucket. Both are upserts in the transition's own
+# transaction, so a stats read costs O(days), however many tasks there are.
+TIME_TO_DONE_BUCKETS = [
+    ("1h", timedelta(hours=1)),
+    ("4h", timedelta(hours=4)),
+    ("1d", timedelta(days=1)),
+    ("3d", timedelta(days=3)),
+    ("1w", timedelta(weeks=1)),
+    ("2w", timedelta(weeks=2)),
+    ("30d", timedelta(days=30)),
+    ("90d", timedelta(days=90)),
+]
+TIME_TO_DONE_LONGER = "longer"
+
+
+def time_to_done_bucket(duration: timedelta) -> str:
+    return next((label for label, limit in TIME_TO_DONE_BUCKETS if duration <= limit), TIME_TO_DONE_LONGER)
+
+
+def time_to_done_seconds(duration: timedelta) -> int:
+    """A duration in whole seconds, rounded to two significant figures."""
+    seconds = max(round(duration.total_seconds()), 0)
+    if seconds < 100:
+        return seconds
+    return round(seconds, 2 - len(str(seconds)))
+
+
+def median_of(counts: List[Tuple[int, int]]) -> Optional[float]:
+    """The median of values given as (value, count) pairs."""
+    total = sum(count for _, count in counts)
+    if not total:
+        return None
+    # The values at the two middle positions (the same one for an odd total)
+    positions = [(total - 1) // 2, total // 2]
+    middle, seen = [], 0
+    for value, count in sorted(counts):
+        seen += count
+        while positions and positions[0] < seen:
+            middle.append(value)
+            positions.pop(0)
+    return sum(middle) / 2
+
+
+class RollupTally:
+    """Transitions counted in memory, to be added to the rollups in one go."""
+
+    def __init__(self):
+        self.days: Dict[Tuple[str, date], Dict[str, int]] = {}
+        self.durations: Dict[Tuple[str, date, str], int] = {}
+        self.times: Dict[Tuple[str, date, int], int] = {}
+
+    def count(
+        self,
+        deck_id: str,
+        at: datetime,
+        completed: int = 0,
+        deferred: int = 0,
+        time_to_done: Optional[timedelta] = None,
+    ) -> None:
+        day = as_utc(at).astimezone(timezone.utc).date()
+        counts = self.days.setdefault((deck_id, day), {"completed": 0, "deferred": 0})
+        counts["completed"] += completed
+        counts["deferred"] += deferred
+        if time_to_done is not None:
+            key = (deck_id, day, time_to_done_bucket(time_to_done))
+            self.durations[key] = self.durations.get(key, 0) + 1
+            key = (deck_id, day, time_to_done_seconds(time_to_done))
+            self.times[key] = self.times.get(key, 0) + 1
+
+    def day_rows(self) -> List[Dict[str, Any]]:
+        return [{"deck_id": deck_id, "day": day, **counts} for (deck_id, day), counts in self.days.items()]
+
+    def duration_rows(self) -> List[Dict[str, Any]]:
+        return [
+            {"deck_id": deck_id, "day": day, "bucket": bucket, "count": count}
+            for (deck_id, day, bucket), count in self.durations.items()
+        ]
+
+    def time_rows(self) -> List[Dict[str, Any]]:
+        return [
+            {"deck_id": deck_id, "day": day, "seconds": seconds, "count": count}
+            for (deck_id, day, seconds), count in self.times.items()
+        ]
+
+
+async def add_to_rollups(db: AsyncSession, tally: RollupTally) -> None:
+    """Add a tally to the rollups, one upsert per table."""
+    if tally.days:
+        upsert = await dialect_insert(db, DBDailyStats)
+        await db.execute(
+            upsert.on_conflict_do_update(
+                index_elements=[DBDailyStats.deck_id, DBDailyStats.day],
+                set_={
+                    "completed": DBDailyStats.completed + upsert.excluded.completed,
+                    "deferred": DBDailyStats.deferred + upsert.excluded.deferred,
+                },
+            ),
+            tally.day_rows(),
+        )
+    if tally.durations:
+        upsert = await dialect_insert(db, DBDoneDuration)
+        await db.execute(
+            upsert.on_conflict_do_update(
+                index_elements=[DBDoneDuration.deck_id, DBDoneDuration.day, DBDoneDuration.bucket],
+                set_={"count": DBDoneDuration.count + upsert.excluded.count},
+            ),
+            tally.duration_rows(),
+        )
+    if tally.times:
+        upsert = await dialect_insert(db, DBDoneTime)
+        await db.execute(
+            upsert.on_conflict_do_update(
+                index_elements=[DBDoneTime.deck_id, DBDoneTime.day, DBDoneTime.seconds],
+                set_={"count": DBDoneTime.count + upsert.excluded.count},
+            ),
+            tally.time_rows(),
+        )
+
+
+async def count_transition(
+    db: AsyncSession,
+    at: datetime,
+    completed: int = 0,
+    deferred: int = 0,
+    time_to_done: Optional[timedelta] = None,
+) -> None:
+    """Add a transition made at `at` to the deck's rollups."""
+    tally = RollupTally()
+    tally.count(deck_of(db), at, completed=completed, deferred=deferred, time_to_done=time_to_done)
+    await add_to_rollups(db, tally)
+
+
+async def read_stats(db: AsyncSession, days: int, top: int) -> Dict[str, Any]:
+    """The deck's rollups for the `days` days ending today (UTC), in the
+    StatsResponse shape."""
+    today = datetime.now(timezone.utc).date()
+    first = today - timedelta(days=days - 1)
+    rows = {
+        row.day: row
+        for row in (await db.execute(
+            select(DBDailyStats.day, DBDailyStats.completed, DBDailyStats.deferred)
+            .where(DBDailyStats.deck_id == deck_of(db), DBDailyStats.day >= first)
+        )).all()
+    }
+    daily = []
+    for offset in range(days):
+        day = first + timedelta(days=offset)
+        row = rows.get(day)
+        daily.append({"day": day, "completed": row.completed if row else 0, "deferred": row.deferred if row else 0})
+
+    buckets = dict.fromkeys([label for label, _ in TIME_TO_DONE_BUCKETS] + [TIME_TO_DONE_LONGER], 0)
+    for bucket, count in (await db.execute(
+        select(DBDoneDuration.bucket, func.sum(DBDoneDuration.count))
+        .where(DBDoneDuration.deck_id == deck_of(db), DBDoneDuration.day >= first)
+        .group_by(DBDoneDuration.bucket)
+    )).all():
+        buckets[bucket] = count
+    median_bucket, seen, total = None, 0, sum(buckets.values())
+    for bucket, count in buckets.items():
+        seen += count
+        if total and seen * 2 >= total:
+            median_bucket = bucket
+            break
+    median_seconds = median_of((await db.execute(
+        select(DBDoneTime.seconds, func.sum(DBDoneTime.count))
+        .where(DBDoneTime.deck_id == deck_of(db), DBDoneTime.day >= first)
+        .group_by(DBDoneTime.seconds)
+    )).all())
+
+    most_deferred = (await db.execute(
+        select(DBTask.id, DBTask.title, DBTask.status, DBTask.deferral_count)
+        .where(DBTask.deck_id == deck_of(db), DBTask.deferral_count > 0)
+        .order_by(DBTask.deferral_count.desc(), DBTask.id.desc())
+        .limit(top)
+    )).all()
+
+    return {
+        "days": daily,
+        "completed": sum(day["completed"] for day in daily),
+        "deferred": sum(day["deferred"] for day in daily),
+        "most_deferred": [row._asdict() for row in most_deferred],
+        "time_to_done": {"median_seconds": median_seconds, "median_bucket": median_bucket, "buckets": buckets},
+    }
+
+
+# --- Writes ---
+# Each write_* function applies one mutation to the session without
+# committing, so a route commits it alone and /batch commits several
+# together (both through run_write). They take the deck lock first, and
+# flush before returning: later reads in the same transaction (sort order
+# lookups, the next batch operation) see the write.
+
+async def write_create_task(db: AsyncSession, task: TaskCreate) -> DBTask:
+    await lock_deck(db)
+    # New tasks go to the bottom of the todo pile
+    new_sort_order = await next_sort_order(db)
 
     db_task = DBTask(
+        deck_id=deck_of(db),
         title=task.title,
         description=task.description,
         # Default status for new tasks is 'todo'
@@ -265,47 +1523,20 @@ async def create_task(task: TaskCreate, db: Session = Depends(get_db)):
         completed=False # Ensure 'completed' is set for new tasks
     )
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
-    return TaskResponse.model_validate(db_task)
-
-
-@app.get("/tasks", response_model=List[TaskResponse])
-async def get_tasks(db: Session = Depends(get_db)):
-    # Fetch all tasks with their substacks
-    tasks = db.query(DBTask).all()
-
-    # Separate tasks by status
-    todo_tasks = []
-    done_tasks = []
-    
-    for task in tasks:
-        if task.status == "todo":
-            todo_tasks.append(task)
-        elif task.status == "done":
-            done_tasks.append(task)
-
-    # Sort todo tasks by sort_order (ascending)
-    todo_tasks.sort(key=lambda t: t.sort_order if t.sort_order is not None else float('inf'))
-
-    # Sort done tasks by completed_at in descending order (most recent first)
-    done_tasks.sort(key=lambda t: (t.completed_at is not None, t.completed_at), reverse=True)
+    record_change(db, db_task)
+    await db.flush()
+    return db_task
 
-    return [TaskResponse.model_validate(task) for task in todo_tasks + done_tasks]
 
-
-@app.put("/tasks/{task_id}", response_model=TaskResponse)
-async def update_task(
-    task_id: uuid.UUID,
-    task_update: TaskUpdate,
-    db: Session = Depends(get_db)
-):
-    db_task = db.query(DBTask).filter(DBTask.id == task_id).first()
+async def write_update_task(db: AsyncSession, task_id: uuid.UUID, task_update: TaskUpdate) -> DBTask:
+    await lock_deck(db)
+    db_task = (await db.execute(
+        select(DBTask).where(DBTask.id == task_id, DBTask.deck_id == deck_of(db))
+    )).scalar_one_or_none()
     if db_task is None:
         raise HTTPException(status_code=404, detail="Task not found")
 
     original_status = db_task.status
-    original_sort_order = db_task.sort_order
 
     # Apply title/description updates directly
     if task_update.title is not None:
@@ -319,38 +1550,15 @@ async def update_task(
         if db_task.status == "todo":
             db_task.deferred_at = datetime.now(timezone.utc)
             db_task.deferral_count += 1
+            await count_transition(db, db_task.deferred_at, deferred=1)
 
-            # 1. Shift tasks that were below the original_sort_order UP by 1
-            #    This only affects tasks that are currently 'todo'
-            if original_sort_order is not None:
-                db.query(DBTask).filter(
-                    DBTask.status == "todo",
-                    DBTask.sort_order > original_sort_order
-                ).update(
-                    {DBTask.sort_order: DBTask.sort_order - 1},
-                    synchronize_session=False
-                )
-
-            # 2. Find the maximum sort_order among all 'todo' tasks *after* the shift
-            max_order_result = db.query(func.max(DBTask.sort_order)).filter(
-                DBTask.status == "todo"
-            ).scalar()
-
-            new_sort_order = (max_order_result or 0) + 1
-
-            # 3. Assign the new maximum sort_order to the *currently deferring task*
-            db_task.sort_order = new_sort_order
+            # Move the task to the bottom; nothing else in the deck moves
+            db_task.sort_order = await next_sort_order(db)
         else:
             raise HTTPException(status_code=400, detail="Cannot defer a non-todo task.")
-        
-        db.add(db_task)
-        db.commit()
-        db.refresh(db_task)
-        return TaskResponse.model_validate(db_task)
-
 
     # --- STATUS CHANGE LOGIC (todo <-> done) ---
-    if task_update.status is not None and task_update.status != original_status:
+    elif task_update.status is not None and task_update.status != original_status:
         db_task.status = task_update.status
 
         # Update the redundant 'completed' field for frontend compatibility
@@ -359,46 +1567,38 @@ async def update_task(
         elif db_task.status == "todo":
             db_task.completed = False
 
-        # If status changes FROM 'todo' TO 'done'
-        if task_update.status == "done" and original_status == "todo":
+        # Every done task has a completed_at (the done pile pages on it) and
+        # every todo task a sort_order
+        if task_update.status == "done":
             db_task.completed_at = datetime.now(timezone.utc)
             db_task.deferred_at = None
-            
-            if original_sort_order is not None:
-                db.query(DBTask).filter(
-                    DBTask.status == "todo",
-                    DBTask.sort_order > original_sort_order
-                ).update(
-                    {DBTask.sort_order: DBTask.sort_order - 1},
-                    synchronize_session=False
-                )
             db_task.sort_order = None # No sort_order for done tasks
+            await count_transition(
+                db, db_task.completed_at, completed=1,
+                time_to_done=db_task.completed_at - as_utc(db_task.created_at),
+            )
 
-        # If status changes FROM 'done' TO 'todo' (re-activate)
-        elif task_update.status == "todo" and original_status == "done":
+        # Re-activate
+        else:
             db_task.completed_at = None
             db_task.deferred_at = None 
-            
-            db.query(DBTask).filter(DBTask.status == "todo").update(
-                {DBTask.sort_order: DBTask.sort_order + 1},
-                synchronize_session=False
-            )
-            db_task.sort_order = 1 
 
+            # Back on top of the deck. Nothing has been flushed yet, so the
+            # lookup still sees this task as done.
+            db_task.sort_order = await top_sort_order(db)
 
-    # Commit changes that happened outside the is_deferral block
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
-    return TaskResponse.model_validate(db_task)
+    record_change(db, db_task)
+    await db.flush()
+    return db_task
 
 
-# --- Substack API Endpoints ---
-
-@app.post("/tasks/{task_id}/substacks", response_model=SubstackResponse, status_code=status.HTTP_201_CREATED)
-async def create_substack(task_id: uuid.UUID, substack: SubstackCreate, db: Session = Depends(get_db)):
+async def write_create_substack(db: AsyncSession, task_id: uuid.UUID, substack: SubstackCreate) -> DBSubstack:
+    await lock_deck(db)
     # Check if parent task exists
-    parent_task = db.query(DBTask).filter(DBTask.id == task_id).first()
+    parent_task = (await db.execute(
+        select(DBTask).where(DBTask.id == task_id, DBTask.deck_id == deck_of(db))
+    )).scalar_one_or_none()
     if parent_task is None:
         raise HTTPException(status_code=404, detail="Parent task not found")
     
@@ -407,22 +1607,26 @@ async def create_substack(task_id: uuid.UUID, substack: SubstackCreate, db: Sess
         parent_task_id=task_id
     )
     db.add(db_substack)
-    db.commit()
-    db.refresh(db_substack)
-    return SubstackResponse.model_validate(db_substack)
+    record_change(db, db_substack)
+    await db.flush()
+    return db_substack
 
 
-@app.post("/substacks/{substack_id}/tasks", response_model=SubstackTaskResponse, status_code=status.HTTP_201_CREATED)
-async def create_substack_task(substack_id: uuid.UUID, task: SubstackTaskCreate, db: Session = Depends(get_db)):
+async def write_create_substack_task(db: AsyncSession, substack_id: uuid.UUID, task: SubstackTaskCreate) -> DBSubstackTask:
+    await lock_deck(db)
     # Check if substack exists
-    substack = db.query(DBSubstack).filter(DBSubstack.id == substack_id).first()
+    substack = (await db.execute(
+        select(DBSubstack)
+        .join(DBSubstack.parent_task)
+        .where(DBSubstack.id == substack_id, DBTask.deck_id == deck_of(db))
+    )).scalar_one_or_none()
     if substack is None:
         raise HTTPException(status_code=404, detail="Substack not found")
     
     # Find the maximum sort_order for existing tasks in this substack
-    max_order_result = db.query(func.max(DBSubstackTask.sort_order)).filter(
-        DBSubstackTask.substack_id == substack_id
-    ).scalar()
+    max_order_result = (await db.execute(
+        select(func.max(DBSubstackTask.sort_order)).where(DBSubstackTask.substack_id == substack_id)
+    )).scalar()
     
     new_sort_order = (max_order_result or 0) + 1
     
@@ -433,14 +1637,19 @@ async def create_substack_task(substack_id: uuid.UUID, task: SubstackTaskCreate,
         sort_order=new_sort_order
     )
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
-    return SubstackTaskResponse.model_validate(db_task)
-
-
-@app.put("/substack-tasks/{task_id}", response_model=SubstackTaskResponse)
-async def update_substack_task(task_id: uuid.UUID, task_update: dict, db: Session = Depends(get_db)):
-    db_task = db.query(DBSubstackTask).filter(DBSubstackTask.id == task_id).first()
+    record_change(db, db_task)
+    await db.flush()
+    return db_task
+
+
+async def write_update_substack_task(db: AsyncSession, task_id: uuid.UUID, task_update: dict) -> DBSubstackTask:
+    await lock_deck(db)
+    db_task = (await db.execute(
+        select(DBSubstackTask)
+        .join(DBSubstackTask.substack)
+        .join(DBSubstack.parent_task)
+        .where(DBSubstackTask.id == task_id, DBTask.deck_id == deck_of(db))
+    )).scalar_one_or_none()
     if db_task is None:
         raise HTTPException(status_code=404, detail="Substack task not found")
     
@@ -452,7 +1661,1316 @@ async def update_substack_task(task_id: uuid.UUID, task_update: dict, db: Sessio
             db_task.completed_at = None
     
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
+    record_change(db, db_task)
+    await db.flush()
+    return db_task
+
+
+async def changes_between(db: AsyncSession, since: int, cursor: int) -> ChangesResponse:
+    """Current state of every row logged in deck versions (since, cursor]."""
+    def changed(entity: str):
+        return select(DBChange.entity_id).where(
+            DBChange.deck_id == deck_of(db),
+            DBChange.version > since,
+            DBChange.version <= cursor,
+            DBChange.entity == entity,
+        )
+
+    tasks = (await db.execute(
+        select(DBTask).options(TASK_TREE).where(DBTask.id.in_(changed(DBTask.__tablename__)))
+    )).scalars().all()
+    substacks = (await db.execute(
+        select(DBSubstack)
+        .options(selectinload(DBSubstack.tasks))
+        .where(DBSubstack.id.in_(changed(DBSubstack.__tablename__)))
+    )).scalars().all()
+    substack_tasks = (await db.execute(
+        select(DBSubstackTask).where(DBSubstackTask.id.in_(changed(DBSubstackTask.__tablename__)))
+    )).scalars().all()
+    archived_task_ids = (await db.execute(changed(DBArchivedTask.__tablename__))).scalars().all()
+
+    return ChangesResponse(
+        cursor=cursor,
+        tasks=[TaskResponse.model_validate(t) for t in tasks],
+        substacks=[SubstackResponse.model_validate(s) for s in substacks],
+        substack_tasks=[SubstackTaskResponse.model_validate(t) for t in substack_tasks],
+        archived_task_ids=archived_task_ids,
+    )
+
+
+# --- Import ---
+# Imports write rows with Core executemany (COPY on Postgres) a batch at a
+# time instead of going through the ORM, so a large backup streams through
+# in bounded memory. Every row gets a fresh id: an import is a copy, and must
+# not collide with the cards it was exported from.
+IMPORT_BATCH_SIZE = 1000
+DEFAULT_SUBSTACK_NAME = "Sub-tasks"
+
+
+async def bulk_insert(db: AsyncSession, model: Base, rows: List[Dict[str, Any]]) -> None:
+    if not rows:
+        return
+    connection = await db.connection()
+    if connection.dialect.name == "postgresql":
+        raw = await connection.get_raw_connection()
+        columns = list(rows[0])
+        await raw.driver_connection.copy_records_to_table(
+            model.__tablename__,
+            columns=columns,
+            records=[tuple(row[column] for column in columns) for row in rows],
+        )
+    else:
+        await db.execute(insert(model), rows)
+
+
+class TaskImporter:
+    """Writes imported tasks in batches, appending them to the todo pile in order."""
+
+    def __init__(self, db: AsyncSession, version: int, first_sort_order: int):
+        self.db = db
+        self.version = version
+        self.next_sort_order = first_sort_order
+        self.pending: List[ImportTask] = []
+        self.counts = {"tasks": 0, "substacks": 0, "substack_tasks": 0}
+
+    async def add(self, task: ImportTask) -> None:
+        if task.trashed_at is not None:
+            return
+        self.pending.append(task)
+        if len(self.pending) >= IMPORT_BATCH_SIZE:
+            await self.flush()
+
+    async def flush(self) -> None:
+        now = datetime.now(timezone.utc)
+        task_rows, substack_rows, card_rows, change_rows = [], [], [], []
+        tally = RollupTally()
+        for task in self.pending:
+            task_id = uuid.uuid4()
+            done = task.status == "done" or (task.status is None and task.completed)
+            task_rows.append({
+                "id": task_id,
+                "deck_id": deck_of(self.db),
+                "title": task.title,
+                "description": task.description,
+                "completed": done,
+                "status": "done" if done else "todo",
+                "created_at": task.created_at or now,
+                "completed_at": (task.completed_at or now) if done else None,
+                "deferred_at": None if done else task.deferred_at,
+                "deferral_count": task.deferral_count,
+                "sort_order": None if done else self.next_sort_order,
+                "external_id": task.external_id,
+                "source": task.source,
+            })
+            # Imported history counts in GET /stats, as the backfill of
+            # existing tasks does
+            # Done tasks imported without a completed_at are stamped with the
+            # import time, which isn't when they were done: not counted
+            row = task_rows[-1]
+            if done and task.completed_at is not None:
+                tally.count(
+                    deck_of(self.db), row["completed_at"], completed=1,
+                    time_to_done=as_utc(row["completed_at"]) - as_utc(row["created_at"]),
+                )
+            elif row["deferred_at"] is not None and row["deferral_count"]:
+                tally.count(deck_of(self.db), row["deferred_at"], deferred=row["deferral_count"])
+            if not done:
+                self.next_sort_order += 1
+            change_rows.append({
+                "deck_id": deck_of(self.db),
+                "version": self.version,
+                "entity": DBTask.__tablename__,
+                "entity_id": task_id,
+            })
+            for substack in task.substacks:
+                substack_id = uuid.uuid4()
+                substack_rows.append({
+                    "id": substack_id,
+                    "name": substack.name or DEFAULT_SUBSTACK_NAME,
+                    "parent_task_id": task_id,
+                    "created_at": substack.created_at or now,
+                })
+                for sort_order, card in enumerate(substack.tasks, start=1):
+                    card_rows.append({
+                        "id": uuid.uuid4(),
+                        "title": card.title,
+                        "description": card.description,
+                        "completed": card.completed,
+                        "substack_id": substack_id,
+                        "created_at": card.created_at or now,
+                        "completed_at": (card.completed_at or now) if card.completed else None,
+                        "sort_order": sort_order,
+                    })
+
+        await bulk_insert(self.db, DBTask, task_rows)
+        await bulk_insert(self.db, DBSubstack, substack_rows)
+        await bulk_insert(self.db, DBSubstackTask, card_rows)
+        await bulk_insert(self.db, DBChange, change_rows)
+        await add_to_rollups(self.db, tally)
+        self.counts["tasks"] += len(task_rows)
+        self.counts["substacks"] += len(substack_rows)
+        self.counts["substack_tasks"] += len(card_rows)
+        self.pending = []
+
+
+async def ndjson_lines(request: Request):
+    """Yield the non-blank lines of a streamed NDJSON body."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def import_documents(request: Request):
+    """The tasks of an import body, one at a time.
+
+    NDJSON bodies (one task per line, e.g. from a script or an export) are
+    read incrementally. A JSON body is an app backup — `{ decks }` (v3+) or
+    `{ tasks }` (v1/v2) — and is parsed whole; cards from every root deck
+    of the backup are imported into the caller's deck.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonl" in content_type:
+        line_number = 0
+        async for line in ndjson_lines(request):
+            line_number += 1
+            yield f"Line {line_number}", line
+        return
+
+    try:
+        document = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body is not valid JSON")
+    if isinstance(document, dict) and isinstance(document.get("decks"), list):
+        cards = []
+        for index, deck in enumerate(document["decks"]):
+            if not isinstance(deck, dict) or not isinstance(deck.get("cards", []), list):
+                raise HTTPException(status_code=400, detail=f"Deck {index}: expected an object with a cards list")
+            cards.extend(deck.get("cards", []))
+    elif isinstance(document, dict) and isinstance(document.get("tasks"), list):
+        cards = document["tasks"]
+    elif isinstance(document, list):
+        cards = document
+    else:
+        raise HTTPException(status_code=400, detail="Expected a backup with decks or tasks")
+    for index, card in enumerate(cards):
+        yield f"Task {index}", card
+
+
+# --- Export ---
+EXPORT_BATCH_SIZE = 500
+
+
+async def export_lines(sessions: async_sessionmaker, deck_id: str):
+    """Every task in a deck as an NDJSON line, in deck order, a batch at a time.
+
+    Rows come through a server-side cursor; each batch's substack trees are
+    loaded with it and the batch is dropped from the session once written,
+    so memory stays flat however large the deck is.
+    """
+    async with sessions() as db:
+        for view in ("todo", "done"):
+            result = await db.stream_scalars(
+                task_view_query(deck_id, view)
+                .options(TASK_TREE)
+                .execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            async for batch in result.partitions():
+                yield "".join(
+                    TaskResponse.model_validate(task).model_dump_json() + "\n"
+                    for task in batch
+                )
+                # Cascades to the task's substacks and their cards
+                for task in batch:
+                    db.expunge(task)
+        # Archived history last; it is already stored in the export shape
+        result = await db.stream_scalars(
+            archive_view_query(deck_id)
+            .with_only_columns(DBArchivedTask.document)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for batch in result.partitions():
+            yield "".join(document + "\n" for document in batch)
+
+
+# --- Search ---
+# GET /search matches words against the title and description of tasks and
+# substack tasks. On SQLite each table has an external-content FTS5 index
+# (holding only the index, not a second copy of the text) that triggers keep
+# in step with every insert, update and delete, bulk imports and archiving
+# included. FTS5 ties index entries to the tables' implicit rowids, which
+# VACUUM may renumber; run a 'rebuild' of both indexes after one. On
+# Postgres a GIN index over the same tsvector expression the search query
+# uses does the job, and needs no triggers.
+SEARCH_TABLES = ["tasks", "substack_tasks"]
+MAX_SEARCH_TERMS = 16
+
+
+def search_document(table: str = "") -> str:
+    """The tsvector a table's rows are searched by (and GIN-indexed on);
+    `table` qualifies its columns where a join makes them ambiguous."""
+    prefix = f"{table}." if table else ""
+    return f"to_tsvector('simple', coalesce({prefix}title, '') || ' ' || coalesce({prefix}description, ''))"
+def create_search_index(connection) -> None:
+    if connection.dialect.name == "postgresql":
+        for table in SEARCH_TABLES:
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} "
+                f"USING gin ({search_document()})"
+            ))
+        return
+    for table in SEARCH_TABLES:
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": f"{table}_fts"}
+        ).first()
+        if not exists:
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {table}_fts USING fts5("
+                f"title, description, content='{table}', content_rowid='rowid')"
+            ))
+        insert_row = f"INSERT INTO {table}_fts(rowid, title, description) VALUES (new.rowid, new.title, new.description);"
+        delete_row = (
+            f"INSERT INTO {table}_fts({table}_fts, rowid, title, description) "
+            f"VALUES ('delete', old.rowid, old.title, old.description);"
+        )
+        connection.execute(text(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert_row} END"))
+        connection.execute(text(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete_row} END"))
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF title, description ON {table} "
+            f"BEGIN {delete_row} {insert_row} END"
+        ))
+        if not exists:
+            # Index what an existing database already holds
+            connection.execute(text(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')"))
+
+
+# Each search is one ranked UNION over both indexes, restricted to the
+# caller's deck and keyset-paginated on (score, id). On SQLite, CROSS JOIN
+# pins the join order so the matches drive the lookup; left to itself the
+# planner walks the whole deck by its deck_id index and probes the FTS index
+# once per task.
+SQLITE_SEARCH = """
+SELECT * FROM (
+    SELECT 'task' AS kind, tasks.id AS id, tasks.id AS task_id, tasks.title AS title,
+           tasks.description AS description, tasks.completed AS completed,
+           -bm25(tasks_fts) AS score
+    FROM tasks_fts CROSS JOIN tasks ON tasks.rowid = tasks_fts.rowid
+    WHERE tasks_fts MATCH :query AND tasks.deck_id = :deck_id
+    UNION ALL
+    SELECT 'substack_task', substack_tasks.id, substacks.parent_task_id, substack_tasks.title,
+           substack_tasks.description, substack_tasks.completed, -bm25(substack_tasks_fts)
+    FROM substack_tasks_fts
+    CROSS JOIN substack_tasks ON substack_tasks.rowid = substack_tasks_fts.rowid
+    JOIN substacks ON substacks.id = substack_tasks.substack_id
+    JOIN tasks ON tasks.id = substacks.parent_task_id
+    WHERE substack_tasks_fts MATCH :query AND tasks.deck_id = :deck_id
+) AS hits
+"""
+POSTGRES_SEARCH = f"""
+SELECT * FROM (
+    SELECT 'task' AS kind, tasks.id AS id, tasks.id AS task_id, tasks.title AS title,
+           tasks.description AS description, tasks.completed AS completed,
+           ts_rank({search_document("tasks")}, to_tsquery('simple', :query)) AS score
+    FROM tasks
+    WHERE {search_document("tasks")} @@ to_tsquery('simple', :query)
+      AND tasks.deck_id = :deck_id
+    UNION ALL
+    SELECT 'substack_task', substack_tasks.id, substacks.parent_task_id, substack_tasks.title,
+           substack_tasks.description, substack_tasks.completed,
+           ts_rank({search_document("substack_tasks")}, to_tsquery('simple', :query))
+    FROM substack_tasks
+    JOIN substacks ON substacks.id = substack_tasks.substack_id
+    JOIN tasks ON tasks.id = substacks.parent_task_id
+    WHERE {search_document("substack_tasks")} @@ to_tsquery('simple', :query)
+      AND tasks.deck_id = :deck_id
+) AS hits
+"""
+
+
+def search_terms(q: str) -> List[str]:
+    """The words of a search box query; punctuation (and so any query
+    syntax) is dropped."""
+    return re.findall(r"\w+", q)[:MAX_SEARCH_TERMS]
+
+
+async def search(db: AsyncSession, q: str, limit: int, cursor: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Up to `limit` matches for every word of `q` (each as a prefix), best first."""
+    terms = search_terms(q)
+    if not terms:
+        return []
+    dialect = (await db.connection()).dialect.name
+    if dialect == "postgresql":
+        sql, query = POSTGRES_SEARCH, " & ".join(f"{term}:*" for term in terms)
+    else:
+        sql, query = SQLITE_SEARCH, " ".join(f'"{term}"*' for term in terms)
+    params = {"query": query, "deck_id": deck_of(db), "limit": limit}
+    after = []
+    if cursor is not None:
+        sql += " WHERE (score, id) < (:after_score, :after_id)"
+        after = [bindparam("after_id", type_=UUID())]
+        params["after_score"], params["after_id"] = decode_cursor("search", cursor)
+    statement = (
+        text(sql + " ORDER BY score DESC, id DESC LIMIT :limit")
+        .bindparams(*after)
+        .columns(id=UUID(), task_id=UUID(), completed=Boolean(), score=Float())
+    )
+    return [row._asdict() for row in (await db.execute(statement, params)).all()]
+
+
+# --- Archive ---
+# Done tasks pile up forever while the active deck stays small, so tasks
+# completed long ago are moved to tasks_archive: the hot tables (and their
+# indexes) only hold the todo pile and recent history. An archived task is
+# stored as one JSON document in the GET /tasks shape, its substacks and
+# cards included, and is only read back by GET /tasks/archived and /export.
+ARCHIVE_BATCH_SIZE = 500
+
+
+def archive_view_query(deck_id: str, cursor: Optional[str] = None):
+    """A deck's archived tasks, most recently completed first, after `cursor`."""
+    query = (
+        select(DBArchivedTask)
+        .where(DBArchivedTask.deck_id == deck_id)
+        .order_by(DBArchivedTask.completed_at.desc(), DBArchivedTask.id.desc())
+    )
+    if cursor is not None:
+        query = query.where(
+            tuple_(DBArchivedTask.completed_at, DBArchivedTask.id) < decode_cursor("archived", cursor)
+        )
+    return query
+
+
+def archivable_query(deck_id: str, before: datetime):
+    return task_view_query(deck_id, "done").where(DBTask.completed_at < before)
+
+
+async def write_archive_tasks(db: AsyncSession, before: datetime) -> int:
+    """Move up to ARCHIVE_BATCH_SIZE of the deck's tasks completed before
+    `before` to the archive. Returns how many were moved."""
+    version = await lock_deck(db)
+    tasks = await read_tasks(db, archivable_query(deck_of(db), before).limit(ARCHIVE_BATCH_SIZE))
+    if not tasks:
+        return 0
+    now = datetime.now(timezone.utc)
+    await db.execute(insert(DBArchivedTask), [
+        {
+            "id": task["id"],
+            "deck_id": deck_of(db),
+            "completed_at": task["completed_at"],
+            "archived_at": now,
+            "document": orjson.dumps(task, option=orjson.OPT_UTC_Z).decode(),
+        }
+        for task in tasks
+    ])
+    task_ids = [task["id"] for task in tasks]
+    # Logged as archived (not as changed tasks), so syncing clients learn
+    # the tasks left the deck
+    await db.execute(insert(DBChange), [
+        {"deck_id": deck_of(db), "version": version, "entity": DBArchivedTask.__tablename__, "entity_id": task_id}
+        for task_id in task_ids
+    ])
+    substack_ids = select(DBSubstack.id).where(DBSubstack.parent_task_id.in_(task_ids))
+    for statement in (
+        delete(DBSubstackTask).where(DBSubstackTask.substack_id.in_(substack_ids)),
+        delete(DBSubstack).where(DBSubstack.parent_task_id.in_(task_ids)),
+        delete(DBTask).where(DBTask.id.in_(task_ids)),
+    ):
+        await db.execute(statement.execution_options(synchronize_session=False))
+    return len(tasks)
+
+
+async def archive_done_tasks(sessions: async_sessionmaker, older_than: timedelta) -> int:
+    """Archive every deck's tasks completed more than `older_than` ago.
+
+    Each batch is its own write (one deck version), so live writes to the
+    deck only ever wait behind one batch. Returns how many tasks were moved.
+    """
+    before = datetime.now(timezone.utc) - older_than
+    async with sessions() as db:
+        decks = (await db.execute(select(DBDeckState.deck_id))).scalars().all()
+    archived = 0
+    for deck_id in decks:
+        async with sessions(info={"deck_id": deck_id}) as db:
+            # Checked before taking the deck lock, so decks with nothing to
+            # archive don't get a new version
+            while (await db.execute(archivable_query(deck_id, before).with_only_columns(DBTask.id).limit(1))).first():
+                archived += await run_write(db, lambda: write_archive_tasks(db, before))
+    return archived
+
+
+async def archive_periodically(sessions: async_sessionmaker) -> None:
+    while True:
+        await asyncio.sleep(settings.ARCHIVE_INTERVAL_SECONDS)
+        try:
+            archived = await archive_done_tasks(sessions, timedelta(days=settings.ARCHIVE_AFTER_DAYS))
+        except Exception:
+            logger.exception("Archiving done tasks failed")
+            continue
+        if archived:
+            logger.info("Archived %d done tasks", archived)
+
+
+# --- Events ---
+# GET /events streams a deck's changes as Server-Sent Events, so other
+# devices apply deltas instead of polling. A committed write publishes just
+# (deck, version) to the broker; each open stream then reads what changed
+# since the last version it sent from the change log (as /changes does) and
+# sends it as one event whose id is the new version. Bursts of writes
+# coalesce into one event, and a client that reconnects with Last-Event-ID
+# gets everything it missed first.
+EVENTS_RETRY_MS = 3000
+EVENTS_CHANNEL = "onejob_events"
+
+
+class LocalBroker:
+    """Delivers versions to the streams of this process only."""
+
+    def __init__(self):
+        self.subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, db: AsyncSession, deck_id: str, version: int) -> None:
+        """Announce a committed deck version."""
+        self.deliver(deck_id, version)
+
+    def deliver(self, deck_id: str, version: int) -> None:
+        for queue in self.subscribers.get(deck_id, []):
+            queue.put_nowait(version)
+
+    @asynccontextmanager
+    async def subscribe(self, deck_id: str):
+        queue: asyncio.Queue = asyncio.Queue()
+        self.subscribers.setdefault(deck_id, []).append(queue)
+        try:
+            yield queue
+        finally:
+            self.subscribers[deck_id].remove(queue)
+            if not self.subscribers[deck_id]:
+                del self.subscribers[deck_id]
+
+
+class PostgresBroker(LocalBroker):
+    """Shares versions between every worker on a Postgres database through
+    LISTEN/NOTIFY: writers notify, and each process keeps one listening
+    connection that hands notifications to its local streams and
+    invalidates the deck in its response cache."""
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self.connection = None
+
+    async def start(self) -> None:
+        import asyncpg
+
+        self.connection = await asyncpg.connect(self.dsn)
+        await self.connection.add_listener(EVENTS_CHANNEL, self.notified)
+
+    async def stop(self) -> None:
+        if self.connection is not None:
+            await self.connection.close()
+
+    def notified(self, connection, pid, channel, payload) -> None:
+        deck_id, version = json.loads(payload)
+        # The write may have come from another worker, whose commit
+        # invalidated only its own cache
+        response_cache.invalidate(deck_id)
+        self.deliver(deck_id, version)
+
+    async def publish(self, db: AsyncSession, deck_id: str, version: int) -> None:
+        # Sent after the write's commit, so listeners can already read it
+        await db.execute(select(func.pg_notify(EVENTS_CHANNEL, json.dumps([deck_id, version]))))
+        await db.commit()
+
+
+def create_broker():
+    if settings.EVENTS_BROKER == "postgres":
+        # asyncpg takes a plain postgresql:// DSN, without the driver suffix
+        return PostgresBroker(settings.DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1))
+    return LocalBroker()
+
+
+event_broker = create_broker()
+
+
+async def event_stream(sessions: async_sessionmaker, deck_id: str, since: Optional[int]):
+    """The SSE body of GET /events: changes after version `since` (or from
+    now on, if None), then every change as it is committed."""
+    # Subscribe before reading the current version: a write committed after
+    # the read is then always announced, and one before it is caught up.
+    async with event_broker.subscribe(deck_id) as queue:
+        async with sessions(info={"deck_id": deck_id}) as db:
+            sent = await deck_version(db) if since is None else since
+        queue.put_nowait(sent + 1)  # catch up (a no-op if nothing is newer)
+        yield f"retry: {EVENTS_RETRY_MS}\n\n"
+
+        while True:
+            try:
+                version = await asyncio.wait_for(queue.get(), timeout=settings.EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            while not queue.empty():
+                version = max(version, queue.get_nowait())
+            async with sessions(info={"deck_id": deck_id}) as db:
+                version = min(version, await deck_version(db))
+                if version <= sent:
+                    continue
+                changes = await changes_between(db, sent, version)
+            yield f"id: {version}\nevent: changes\ndata: {changes.model_dump_json()}\n\n"
+            sent = version
+
+
+# --- Metrics ---
+# Per-route request latency, requests in flight and the SQL each request ran,
+# served as Prometheus text from GET /metrics. Like the response cache these
+# live in process memory, so each worker reports its own numbers.
+logger = logging.getLogger("onejob")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    """Cumulative bucket counts, a running sum and a count, as Prometheus wants them."""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class RequestStats:
+    """SQL run on behalf of one request, filled in by the engine events below."""
+
+    def __init__(self, keep_statements: bool):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.log: Optional[List[Tuple[float, str]]] = [] if keep_statements else None
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+# Registered on the Engine class so every engine is covered, including the
+# ones tests and benchmarks build. SQLAlchemy runs these inside the request's
+# context, so the statements land on the request that issued them.
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_request.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request.get()
+    if stats is None or not conn.info.get("query_started"):
+        return
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats.statements += 1
+    stats.sql_seconds += elapsed
+    if stats.log is not None:
+        stats.log.append((elapsed, statement))
+
+
+class Metrics:
+    def __init__(self):
+        self.in_flight = 0
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.statements: Dict[Tuple[str, str], Histogram] = {}
+        self.sql_seconds: Dict[Tuple[str, str], float] = {}
+        self.responses: Dict[Tuple[str, str, int], int] = {}
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float, stats: RequestStats) -> None:
+        key = (method, route)
+        self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+        self.statements.setdefault(key, Histogram(STATEMENT_BUCKETS)).observe(stats.statements)
+        self.sql_seconds[key] = self.sql_seconds.get(key, 0.0) + stats.sql_seconds
+        self.responses[(method, route, status_code)] = self.responses.get((method, route, status_code), 0) + 1
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def labels(**values: Any) -> str:
+            return "{" + ",".join(f'{k}="{v}"' for k, v in values.items()) + "}"
+
+        def histogram(name: str, series: Dict[Tuple[str, str], Histogram]) -> None:
+            for (method, route), h in sorted(series.items()):
+                for bound, count in zip(h.buckets, h.counts):
+                    lines.append(f"{name}_bucket{labels(method=method, route=route, le=bound)} {count}")
+                lines.append(f"{name}_bucket{labels(method=method, route=route, le='+Inf')} {h.count}")
+                lines.append(f"{name}_sum{labels(method=method, route=route)} {h.sum}")
+                lines.append(f"{name}_count{labels(method=method, route=route)} {h.count}")
+
+        metric("onejob_http_requests_in_flight", "gauge", "Requests currently being served.")
+        lines.append(f"onejob_http_requests_in_flight {self.in_flight}")
+
+        metric("onejob_http_responses_total", "counter", "Responses by route and status code.")
+        for (method, route, code), count in sorted(self.responses.items()):
+            lines.append(f"onejob_http_responses_total{labels(method=method, route=route, status=code)} {count}")
+
+        metric("onejob_http_request_duration_seconds", "histogram", "Time to serve a request, by route.")
+        histogram("onejob_http_request_duration_seconds", self.latency)
+
+        metric("onejob_sql_statements_per_request", "histogram", "SQL statements run per request, by route.")
+        histogram("onejob_sql_statements_per_request", self.statements)
+
+        metric("onejob_sql_duration_seconds_total", "counter", "Time spent in SQL statements, by route.")
+        for (method, route), seconds in sorted(self.sql_seconds.items()):
+            lines.append(f"onejob_sql_duration_seconds_total{labels(method=method, route=route)} {seconds}")
+
+        cache = response_cache.stats()
+        for name in ("hits", "misses", "evictions"):
+            metric(f"onejob_response_cache_{name}_total", "counter", f"Response cache {name}.")
+            lines.append(f"onejob_response_cache_{name}_total {cache[name]}")
+        metric("onejob_response_cache_bytes", "gauge", "Bytes held by the response cache.")
+        lines.append(f"onejob_response_cache_bytes {cache['bytes']}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MetricsMiddleware:
+    """Times each request and collects the SQL it ran.
+
+    A plain ASGI middleware rather than BaseHTTPMiddleware, so streamed
+    responses (GET /export) are timed to their last byte and not buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(keep_statements=settings.SLOW_REQUEST_MS > 0)
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        metrics.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.in_flight -= 1
+            current_request.reset(token)
+            # Label by route template (/tasks/{task_id}), never the raw path,
+            # so the number of series stays fixed.
+            route = getattr(scope.get("route"), "path", "unmatched")
+            metrics.observe(scope["method"], route, status_code, elapsed, stats)
+            if stats.log is not None and elapsed * 1000 >= settings.SLOW_REQUEST_MS:
+                logger.warning(
+                    "Slow request: %s %s took %.1f ms, %d SQL statements in %.1f ms\n%s",
+                    scope["method"], scope["path"], elapsed * 1000, stats.statements, stats.sql_seconds * 1000,
+                    "\n".join(f"  {seconds * 1000:8.2f} ms  {statement}" for seconds, statement in stats.log),
+                )
+
+
+# --- Idempotency ---
+# Mobile clients retry writes on flaky networks. A write sent with an
+# Idempotency-Key header runs once; a retry with the same key (within
+# IDEMPOTENCY_TTL_SECONDS) gets the first response back, status, headers
+# and body, without the route running again. Keys live in the database, so a
+# retry is recognised by whichever worker it reaches.
+IDEMPOTENT_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+
+class WriteProgress:
+    """How far a keyed write got, as seen by IdempotencyMiddleware."""
+
+    def __init__(self):
+        self.committing = False
+        self.committed = False
+
+
+keyed_write: ContextVar[Optional[WriteProgress]] = ContextVar("keyed_write", default=None)
+
+
+async def commit_write(db: AsyncSession) -> None:
+    """Commit a write's transaction, telling the idempotency middleware."""
+    progress = keyed_write.get()
+    if progress is not None:
+        progress.committing = True
+    await db.commit()
+    if progress is not None:
+        progress.committed = True
+
+
+class IdempotencyMiddleware:
+    """Records and replays the responses of keyed writes.
+
+    The key is claimed (a row with no response yet) before the route runs,
+    so a concurrent duplicate is refused with 409 instead of running twice.
+    Responses of 500 and above are not recorded: the key is released and the
+    client may retry, unless the write had already committed. A write that
+    outlives IDEMPOTENCY_TIMEOUT_SECONDS is cancelled with 504 unless it has
+    begun committing, in which case it is seen through and its response
+    recorded. A key left in progress for twice that long therefore belongs
+    to a dead process and may be claimed again. Keys are scoped per deck
+    and bound to the method and path they were first used with.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in IDEMPOTENT_METHODS:
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        key = headers.get("idempotency-key")
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        if not 1 <= len(key) <= 255:
+            await send_json(send, 400, {"detail": "Idempotency-Key must be 1-255 characters"})
+            return
+
+        # Middleware runs outside dependency injection
+        sessions = app_sessions(scope["app"], write=True)
+        deck_id = headers.get("x-deck-id", DEFAULT_DECK)
+
+        async with sessions() as db:
+            record = await db.get(DBIdempotencyKey, (deck_id, key))
+            now = datetime.now(timezone.utc)
+            if record is not None:
+                age = now - as_utc(record.created_at)
+                expired = age > timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS)
+                abandoned = record.status_code is None and age > timedelta(seconds=2 * settings.IDEMPOTENCY_TIMEOUT_SECONDS)
+                if expired or abandoned:
+                    await db.delete(record)
+                    await db.flush()
+                    record = None
+            if record is not None:
+                if (record.method, record.path) != (scope["method"], scope["path"]):
+                    await send_json(send, 422, {"detail": "Idempotency-Key was used for a different request"})
+                elif record.status_code is None:
+                    await send_json(send, 409, {"detail": "A request with this Idempotency-Key is in progress"})
+                else:
+                    await send({
+                        "type": "http.response.start",
+                        "status": record.status_code,
+                        "headers": [
+                            *[(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(record.headers)],
+                            (b"idempotent-replayed", b"true"),
+                        ],
+                    })
+                    await send({"type": "http.response.body", "body": record.body})
+                return
+
+            # Claim the key, dropping expired ones on the way
+            await db.execute(
+                delete(DBIdempotencyKey)
+                .where(DBIdempotencyKey.created_at < now - timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS))
+                .execution_options(synchronize_session=False)
+            )
+            db.add(DBIdempotencyKey(deck_id=deck_id, key=key, method=scope["method"], path=scope["path"], created_at=now))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # A duplicate claimed it first
+                await send_json(send, 409, {"detail": "A request with this Idempotency-Key is in progress"})
+                return
+
+        response: Dict[str, Any] = {"status": 500, "headers": [], "body": b""}
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                response["started"] = True
+                response["status"] = message["status"]
+                response["headers"] = [
+                    (name.decode("latin-1"), value.decode("latin-1")) for name, value in message.get("headers", [])
+                ]
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+            await send(message)
+
+        progress = WriteProgress()
+        token = keyed_write.set(progress)
+        handler = asyncio.ensure_future(self.app(scope, receive, send_and_record))
+        keyed_write.reset(token)
+        try:
+            await asyncio.wait({handler}, timeout=settings.IDEMPOTENCY_TIMEOUT_SECONDS)
+            # Cancelling a write that has begun committing could leave it
+            # committed with its key released, and a retry would run it again
+            if handler.done() or progress.committing:
+                await handler
+            else:
+                handler.cancel()
+                with suppress(asyncio.CancelledError):
+                    await handler
+                if "started" not in response:
+                    await send_json(send, 504, {"detail": "The request timed out"})
+                response["status"] = 504
+        finally:
+            if not handler.done():
+                handler.cancel()
+            async with sessions() as db:
+                record = await db.get(DBIdempotencyKey, (deck_id, key))
+                # Unless our claim expired meanwhile and was dropped, or was
+                # taken over by a later request: then it isn't ours to settle.
+                if record is not None and as_utc(record.created_at) == now:
+                    # Only a write that didn't commit may run again
+                    if response["status"] >= 500 and not progress.committed:
+                        await db.delete(record)
+                    else:
+                        record.status_code = response["status"]
+                        record.headers = json.dumps(response["headers"])
+                        record.body = response["body"]
+                    await db.commit()
+
+
+async def send_json(send, status_code: int, content: Any) -> None:
+    body = orjson.dumps(content)
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def as_utc(moment: datetime) -> datetime:
+    # SQLite hands datetimes back naive
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=timezone.utc)
+
+
+# --- API Endpoints ---
+router = APIRouter()
+
+@router.post("/tasks", response_model=TaskResponse, status_code=status.HTTP_201_CREATED)
+async def create_task(task: TaskCreate, db: AsyncSession = Depends(get_write_db)):
+    db_task = await run_write(db, lambda: write_create_task(db, task))
+    db_task = await get_task_tree(db, db_task.id)
+    return TaskResponse.model_validate(db_task)
+
+
+@router.get("/tasks", response_model=List[TaskResponse])
+async def get_tasks(
+    request: Request,
+    response: Response,
+    view: Optional[TaskStatus] = Query(None, alias="status"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    include: Optional[Literal["substacks"]] = None,
+    deck_id: str = Depends(get_deck_id),
+    db: AsyncSession = Depends(get_db),
+):
+    if (cached := cached_read(request, deck_id)) is not None:
+        return cached
+    generation = response_cache.generation(deck_id)
+    # Sparse fieldsets: ?fields=id,title,status,sort_order returns just those
+    # (id always comes along), without substacks unless ?include=substacks.
+    selected = parse_fields(fields)
+    substacks = selected is None or include == "substacks"
+    if (cached := await not_modified(request, response, db)) is not None:
+        return cached
+
+    # With a status, return one page of that pile; the cursor for the next
+    # page (if any) comes back in the X-Next-Cursor header.
+    if view is not None:
+        page_size = limit or DEFAULT_PAGE_SIZE
+        # The cursor is built from the last task's sort key, so it is
+        # selected even when not asked for, and dropped again below.
+        key = "sort_order" if view == "todo" else "completed_at"
+        tasks = await read_tasks(
+            db,
+            task_view_query(deck_id, view, cursor).limit(page_size + 1),
+            None if selected is None else [*selected, key],
+            substacks,
+        )
+        if len(tasks) > page_size:
+            tasks = tasks[:page_size]
+            response.headers["X-Next-Cursor"] = encode_cursor(view, tasks[-1])
+        if selected is not None and key not in selected:
+            for task in tasks:
+                del task[key]
+        return cache_read(request, deck_id, json_response(tasks, response), generation)
+
+    if limit is not None or cursor is not None:
+        raise HTTPException(status_code=400, detail="Pagination requires a status.")
+
+    # Todo tasks by sort_order (ascending), then done tasks by completed_at
+    # (most recent first). Each pile is one ordered index scan; id breaks ties
+    # so the order is stable. Todo tasks always carry a sort_order and done
+    # tasks a completed_at, so neither needs NULLS handling (which would
+    # force a sort).
+    todo_tasks = await read_tasks(db, task_view_query(deck_id, "todo"), selected, substacks)
+    done_tasks = await read_tasks(db, task_view_query(deck_id, "done"), selected, substacks)
+    return cache_read(request, deck_id, json_response([*todo_tasks, *done_tasks], response), generation)
+
+
+@router.get("/tasks/next", response_model=List[TaskResponse])
+async def get_next_tasks(
+    request: Request,
+    response: Response,
+    n: int = Query(1, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    include: Optional[Literal["substacks"]] = None,
+    deck_id: str = Depends(get_deck_id),
+    db: AsyncSession = Depends(get_db),
+):
+    if (cached := cached_read(request, deck_id)) is not None:
+        return cached
+    generation = response_cache.generation(deck_id)
+    selected = parse_fields(fields)
+    substacks = selected is None or include == "substacks"
+    if (cached := await not_modified(request, response, db)) is not None:
+        return cached
+
+    # The top of the deck (or the top n, for the stack peek): an index seek on
+    # (deck_id, status, sort_order) that costs the same however big the deck is.
+    tasks = await read_tasks(db, task_view_query(deck_id, "todo").limit(n), selected, substacks)
+    return cache_read(request, deck_id, json_response(tasks, response), generation)
+
+
+@router.get("/tasks/archived", response_model=List[TaskResponse])
+async def get_archived_tasks(
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    deck_id: str = Depends(get_deck_id),
+    db: AsyncSession = Depends(get_db),
+):
+    if (cached := cached_read(request, deck_id)) is not None:
+        return cached
+    generation = response_cache.generation(deck_id)
+    if (cached := await not_modified(request, response, db)) is not None:
+        return cached
+
+    # Done history older than ARCHIVE_AFTER_DAYS, paged like ?status=done.
+    # The stored documents are already JSON, so they are spliced into the
+    # body as they are.
+    rows = (await db.execute(
+        archive_view_query(deck_id, cursor)
+        .with_only_columns(DBArchivedTask.id, DBArchivedTask.completed_at, DBArchivedTask.document)
+        .limit(limit + 1)
+    )).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor("archived", rows[-1]._asdict())
+    body = b"[" + b",".join(row.document.encode() for row in rows) + b"]"
+    return cache_read(
+        request, deck_id,
+        Response(content=body, media_type="application/json", headers=dict(response.headers)),
+        generation,
+    )
+
+
+@router.put("/tasks/{task_id}", response_model=TaskResponse)
+async def update_task(
+    task_id: uuid.UUID,
+    task_update: TaskUpdate,
+    db: AsyncSession = Depends(get_write_db)
+):
+    await run_write(db, lambda: write_update_task(db, task_id, task_update))
+    db_task = await get_task_tree(db, task_id)
+    return TaskResponse.model_validate(db_task)
+
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    return response_cache.stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/search", response_model=List[SearchResult])
+async def search_tasks(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=500),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    deck_id: str = Depends(get_deck_id),
+    db: AsyncSession = Depends(get_db),
+):
+    if (cached := cached_read(request, deck_id)) is not None:
+        return cached
+    generation = response_cache.generation(deck_id)
+    if (cached := await not_modified(request, response, db)) is not None:
+        return cached
+
+    results = await search(db, q, limit + 1, cursor)
+    if len(results) > limit:
+        results = results[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor("search", results[-1])
+    return cache_read(request, deck_id, json_response(results, response), generation)
+
+
+@router.get("/stats", response_model=StatsResponse)
+async def get_stats(
+    days: int = Query(30, ge=1, le=366),
+    top: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    # Completions and deferrals per day, the most-deferred tasks and how long
+    # tasks take to get done, over the last `days` days. Read from rollups
+    # (see count_transition), never by scanning tasks.
+    return await read_stats(db, days, top)
+
+
+@router.get("/changes", response_model=ChangesResponse)
+async def get_changes(since: int = Query(0, ge=0), db: AsyncSession = Depends(get_db)):
+    # Everything written after deck version `since`, read through the change
+    # log so the cost follows activity rather than deck size. Rows come back
+    # in their current state, which may already be newer than `cursor`; that
+    # just means the next sync sends them again.
+    cursor = await deck_version(db)
+    if since > cursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return await changes_between(db, since, cursor)
+
+
+@router.get("/events")
+async def stream_events(
+    since: Optional[int] = Query(None, ge=0),
+    last_event_id: Optional[int] = Header(None, alias="Last-Event-ID", ge=0),
+    deck: Optional[str] = Query(None, min_length=1, max_length=64),
+    deck_id: str = Depends(get_deck_id),
+    sessions: async_sessionmaker = Depends(get_sessionmaker),
+):
+    # A browser EventSource can't set headers, so it names its deck in ?deck=
+    deck_id = deck if deck is not None else deck_id
+    # EventSource resends the last event id by itself on reconnect; ?since=
+    # resumes from a cursor the client already had (e.g. from /changes).
+    since = last_event_id if last_event_id is not None else since
+    if since is not None:
+        async with sessions(info={"deck_id": deck_id}) as db:
+            if since > await deck_version(db):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+    return StreamingResponse(
+        event_stream(sessions, deck_id, since),
+        media_type="text/event-stream",
+        # identity: keeps GZipMiddleware from buffering events in its
+        # compressor; no-transform does the same for proxies.
+        headers={"Cache-Control": "no-cache, no-transform", "Content-Encoding": "identity"},
+    )
+
+
+@router.post("/batch", response_model=BatchResponse)
+async def run_batch(batch: BatchRequest, db: AsyncSession = Depends(get_write_db)):
+    # Apply every operation in order in one transaction; the first failure
+    # rolls back the whole batch and reports which operation it was.
+    async def apply() -> Tuple[List[uuid.UUID], int]:
+        version = await lock_deck(db)
+        ids: List[uuid.UUID] = []
+
+        def resolve(ref: BatchRef) -> uuid.UUID:
+            # "$n" names the row created or changed by operation n of this batch
+            if isinstance(ref, str):
+                index = int(ref[1:])
+                if index >= len(ids):
+                    raise HTTPException(status_code=400, detail=f"{ref} refers to a later operation")
+                return ids[index]
+            return ref
+
+        for index, operation in enumerate(batch.operations):
+            try:
+                if operation.op == "create_task":
+                    row = await write_create_task(db, operation)
+                elif operation.op == "defer_task":
+                    row = await write_update_task(db, resolve(operation.task_id), TaskUpdate(is_deferral=True))
+                elif operation.op == "complete_task":
+                    row = await write_update_task(db, resolve(operation.task_id), TaskUpdate(status="done"))
+                elif operation.op == "create_substack":
+                    row = await write_create_substack(db, resolve(operation.task_id), operation)
+                elif operation.op == "add_substack_task":
+                    row = await write_create_substack_task(db, resolve(operation.substack_id), operation)
+                else: # complete_substack_task
+                    row = await write_update_substack_task(db, resolve(operation.task_id), {"completed": True})
+            except HTTPException as exc:
+                raise HTTPException(status_code=exc.status_code, detail=f"Operation {index}: {exc.detail}")
+            ids.append(row.id)
+        return ids, version
+
+    ids, version = await run_write(db, apply)
+    changes = await changes_between(db, version - 1, version)
+    return BatchResponse(ids=ids, **changes.model_dump())
+
+
+@router.get("/export")
+async def export_tasks(
+    deck_id: str = Depends(get_deck_id),
+    sessions: async_sessionmaker = Depends(get_sessionmaker),
+):
+    # NDJSON in the same task shape as GET /tasks, which POST /import reads back
+    return StreamingResponse(
+        export_lines(sessions, deck_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="one-job-export.ndjson"'},
+    )
+
+
+@router.post("/import", response_model=ImportResponse, status_code=status.HTTP_201_CREATED)
+async def import_tasks(request: Request, db: AsyncSession = Depends(get_write_db)):
+    # Append imported tasks (with their substacks) to the bottom of the deck
+    # in one transaction. One deck version covers the whole import. The body
+    # is streamed, so unlike other writes an import can't be rerun after a
+    # write conflict.
+    version = await lock_deck(db)
+    importer = TaskImporter(db, version, await next_sort_order(db))
+    async for label, document in import_documents(request):
+        try:
+            if isinstance(document, bytes):
+                task = ImportTask.model_validate_json(document)
+            else:
+                task = ImportTask.model_validate(document)
+        except ValidationError as exc:
+            await db.rollback()
+            raise HTTPException(status_code=400, detail=f"{label}: {exc.errors()[0]['msg']}")
+        await importer.add(task)
+    await importer.flush()
+    await commit_write(db)
+    response_cache.invalidate(deck_of(db))
+    await publish_version(db, version)
+    return ImportResponse(cursor=version, **importer.counts)
+
+
+# --- Substack API Endpoints ---
+
+@router.post("/tasks/{task_id}/substacks", response_model=SubstackResponse, status_code=status.HTTP_201_CREATED)
+async def create_substack(task_id: uuid.UUID, substack: SubstackCreate, db: AsyncSession = Depends(get_write_db)):
+    db_substack = await run_write(db, lambda: write_create_substack(db, task_id, substack))
+    db_substack = await get_substack_tree(db, db_substack.id)
+    return SubstackResponse.model_validate(db_substack)
+
+
+@router.post("/substacks/{substack_id}/tasks", response_model=SubstackTaskResponse, status_code=status.HTTP_201_CREATED)
+async def create_substack_task(substack_id: uuid.UUID, task: SubstackTaskCreate, db: AsyncSession = Depends(get_write_db)):
+    db_task = await run_write(db, lambda: write_create_substack_task(db, substack_id, task))
+    await db.refresh(db_task)
     return SubstackTaskResponse.model_validate(db_task)
 
+
+@router.put("/substack-tasks/{task_id}", response_model=SubstackTaskResponse)
+async def update_substack_task(task_id: uuid.UUID, task_update: dict, db: AsyncSession = Depends(get_write_db)):
+    db_task = await run_write(db, lambda: write_update_substack_task(db, task_id, task_update))
+    await db.refresh(db_task)
+    return SubstackTaskResponse.model_validate(db_task)
+
+
+# --- App ---
+# CORS configuration to allow frontend to communicate with backend
+origins = [
+    "http://localhost:8080",  # Frontend URL
+    "http://127.0.0.1:8080",  # Alternative frontend URL
+    "http://localhost:5173",  # Vite default port
+    "http://localhost:4173",  # Vite preview
+    "http://127.0.0.1:4173",  # Vite preview
+    "https://onejob.co",      # Production domain
+    "https://www.onejob.co",  # Production www domain
+    "https://design-in-product.github.io",  # GitHub Pages domain
+]
+
+
+def create_app(database_url: Optional[str] = None) -> FastAPI:
+    """Build the API for `database_url` (default: DATABASE_URL).
+
+    Building it touches no database: the engines are opened by the lifespan
+    when the server starts, and the schema is left to `migrate`.
+    """
+    url = async_database_url(database_url or settings.DATABASE_URL)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        engine, write_engine = create_engines(url)
+        # expire_on_commit=False: attributes stay readable after commit
+        # instead of triggering an implicit (and, under asyncio, illegal) reload.
+        app.state.sessions = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+        app.state.write_sessions = async_sessionmaker(write_engine, autoflush=False, expire_on_commit=False)
+        if is_sqlite_memory(url):
+            # A fresh in-memory database; nothing else can have migrated it
+            await migrate(write_engine)
+        response_cache.invalidate()
+        await event_broker.start()
+        archiver = None
+        if settings.ARCHIVE_AFTER_DAYS > 0:
+            archiver = asyncio.create_task(archive_periodically(app_sessions(app, write=True)))
+        yield
+        if archiver is not None:
+            archiver.cancel()
+        await event_broker.stop()
+        await engine.dispose()
+        await write_engine.dispose()
+
+    app = FastAPI(lifespan=lifespan)
+    # Middleware added later wraps what was added before. Idempotency sits
+    # innermost, inside CORS and gzip: recorded responses are stored
+    # uncompressed and replay with fresh CORS headers.
+    app.add_middleware(IdempotencyMiddleware)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["ETag", "X-Next-Cursor", "Idempotent-Replayed"],
+    )
+    # Task lists are repetitive JSON and compress several-fold; small bodies
+    # aren't worth the CPU. (Brotli would need another dependency.)
+    app.add_middleware(GZipMiddleware, minimum_size=settings.GZIP_MIN_BYTES)
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+# What `uvicorn main:app` serves
+app = create_app()
+
+
+async def migrate_database(url: str) -> int:
+    engine, write_engine = create_engines(async_database_url(url))
+    try:
+        return await migrate(write_engine)
+    finally:
+        await engine.dispose()
+        await write_engine.dispose()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="One Job API maintenance")
+    parser.add_argument("command", choices=["migrate"], help="migrate: bring the DATABASE_URL schema up to date")
+    parser.parse_args()
+    print(f"Schema at version {asyncio.run(migrate_database(settings.DATABASE_URL))}")
@@ -6,7 +6,21 @@ Uses the `client` fixture from conftest.py, which provides a fresh
 in-memory database per test.
 """
 
+import asyncio
+import base64
+import json
+import multiprocessing
+import sqlite3
+
+import httpx
 import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import main
+from main import app, create_sqlite_engine, get_sessionmaker, get_write_sessionmaker, migrate
 
 
 def test_complete_workflow(client):
@@ -122,5 +136,1037 @@ def test_task_ordering(client):
     # The deferred task should have a higher sort_order (it was moved to the end)
     assert deferred["sort_order"] >= max(t["sort_order"] for t in todo_tasks if t["id"] != tasks[0]["id"])
 
+def test_task_list_order(client):
+    """Todo tasks come first by sort_order, then done tasks newest first"""
+    ids = [
+        client.post("/tasks", json={"title": f"Task {i+1}"}).json()["id"]
+        for i in range(4)
+    ]
+
+    # Complete tasks 1 then 3, and defer task 2 behind task 4
+    client.put(f"/tasks/{ids[0]}", json={"status": "done"})
+    client.put(f"/tasks/{ids[2]}", json={"status": "done"})
+    client.put(f"/tasks/{ids[1]}", json={"is_deferral": True})
+
+    tasks = client.get("/tasks").json()
+    assert [t["id"] for t in tasks] == [ids[3], ids[1], ids[2], ids[0]]
+    assert [t["status"] for t in tasks] == ["todo", "todo", "done", "done"]
+
+def test_reactivated_task_goes_to_top(client):
+    """A done task brought back to todo sits above every other todo task"""
+    ids = [
+        client.post("/tasks", json={"title": f"Task {i+1}"}).json()["id"]
+        for i in range(3)
+    ]
+    client.put(f"/tasks/{ids[2]}", json={"status": "done"})
+
+    reactivated = client.put(f"/tasks/{ids[2]}", json={"status": "todo"}).json()
+    assert reactivated["completed_at"] is None
+
+    todo = [t for t in client.get("/tasks").json() if t["status"] == "todo"]
+    assert [t["id"] for t in todo] == [ids[2], ids[0], ids[1]]
+    assert reactivated["sort_order"] < todo[1]["sort_order"]
+
+
+def test_conditional_get_follows_every_write(client):
+    """The task list ETag changes on every write and 304s while unchanged"""
+    task_id = client.post("/tasks", json={"title": "Task"}).json()["id"]
+    etag = client.get("/tasks").headers["ETag"]
+    assert client.get("/tasks", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/tasks/next", headers={"If-None-Match": etag}).status_code == 304
+
+    substack_id = client.post(f"/tasks/{task_id}/substacks", json={"name": "Steps"}).json()["id"]
+    card_id = client.post(f"/substacks/{substack_id}/tasks", json={"title": "Step"}).json()["id"]
+    writes = [
+        lambda: client.post("/tasks", json={"title": "Another"}),
+        lambda: client.put(f"/tasks/{task_id}", json={"is_deferral": True}),
+        lambda: client.put(f"/tasks/{task_id}", json={"status": "done"}),
+        lambda: client.post(f"/tasks/{task_id}/substacks", json={"name": "More"}),
+        lambda: client.post(f"/substacks/{substack_id}/tasks", json={"title": "Step 2"}),
+        lambda: client.put(f"/substack-tasks/{card_id}", json={"completed": True}),
+    ]
+    for write in writes:
+        assert write().status_code < 400
+        response = client.get("/tasks", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        etag = response.headers["ETag"]
+
+
+def test_changes_since_cursor(client):
+    """/changes returns only what was written after the cursor"""
+    first = client.post("/tasks", json={"title": "First"}).json()
+    second = client.post("/tasks", json={"title": "Second"}).json()
+
+    initial = client.get("/changes").json()
+    assert {t["id"] for t in initial["tasks"]} == {first["id"], second["id"]}
+    cursor = initial["cursor"]
+
+    assert client.get("/changes", params={"since": cursor}).json() == {
+        "cursor": cursor, "tasks": [], "substacks": [], "substack_tasks": [], "archived_task_ids": [],
+    }
+
+    client.put(f"/tasks/{first['id']}", json={"is_deferral": True})
+    substack = client.post(f"/tasks/{second['id']}/substacks", json={"name": "Steps"}).json()
+    card = client.post(f"/substacks/{substack['id']}/tasks", json={"title": "Step"}).json()
+
+    delta = client.get("/changes", params={"since": cursor}).json()
+    assert delta["cursor"] > cursor
+    assert [t["id"] for t in delta["tasks"]] == [first["id"]]
+    assert delta["tasks"][0]["deferral_count"] == 1
+    assert [s["id"] for s in delta["substacks"]] == [substack["id"]]
+    assert [t["id"] for t in delta["substack_tasks"]] == [card["id"]]
+
+    assert client.get("/changes", params={"since": delta["cursor"] + 1}).status_code == 400
+
+
+def test_batch_builds_a_substack_in_one_request(client):
+    """/batch applies a chain of operations that refer to each other"""
+    response = client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": "Plan trip"},
+        {"op": "create_substack", "task_id": "$0", "name": "Bookings"},
+        {"op": "add_substack_task", "substack_id": "$1", "title": "Flights"},
+        {"op": "add_substack_task", "substack_id": "$1", "title": "Hotel"},
+        {"op": "complete_substack_task", "task_id": "$2"},
+        {"op": "create_task", "title": "Pack"},
+        {"op": "defer_task", "task_id": "$0"},
+    ]})
+    assert response.status_code == 200
+    data = response.json()
+    task_id, substack_id, flights_id, hotel_id = data["ids"][:4]
+
+    assert {t["id"] for t in data["tasks"]} == {task_id, data["ids"][5]}
+    assert {c["id"] for c in data["substack_tasks"]} == {flights_id, hotel_id}
+
+    tasks = client.get("/tasks").json()
+    assert [t["title"] for t in tasks] == ["Pack", "Plan trip"]
+    assert tasks[1]["deferral_count"] == 1
+    cards = tasks[1]["substacks"][0]["tasks"]
+    assert [(c["title"], c["sort_order"], c["completed"]) for c in cards] == [
+        ("Flights", 1, True),
+        ("Hotel", 2, False),
+    ]
+    assert client.get("/changes").json()["cursor"] == data["cursor"]
+
+
+def test_batch_is_all_or_nothing(client):
+    """A failing operation rolls back the whole batch"""
+    response = client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": "Kept?"},
+        {"op": "defer_task", "task_id": "00000000-0000-0000-0000-000000000000"},
+    ]})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Operation 1: Task not found"
+    assert client.get("/tasks").json() == []
+
+    response = client.post("/batch", json={"operations": [
+        {"op": "create_substack", "task_id": "$1", "name": "Too early"},
+    ]})
+    assert response.status_code == 400
+
+
+def test_ndjson_import_appends_to_the_deck(client):
+    """NDJSON import lands below existing tasks with fresh ids"""
+    existing = client.post("/tasks", json={"title": "Already here"}).json()
+    lines = [
+        {"title": "Imported 1", "substacks": [{"name": "Steps", "tasks": [
+            {"title": "Step A"}, {"title": "Step B", "completed": True},
+        ]}]},
+        {"id": existing["id"], "title": "Imported 2"},
+        {"title": "Finished", "status": "done", "completed_at": "2026-01-02T03:04:05+00:00"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\n"
+    response = client.post("/import", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 201
+    assert response.json()["tasks"] == 3
+    assert response.json()["substack_tasks"] == 2
+
+    tasks = client.get("/tasks").json()
+    assert [t["title"] for t in tasks] == ["Already here", "Imported 1", "Imported 2", "Finished"]
+    assert len({t["id"] for t in tasks}) == 4
+    cards = tasks[1]["substacks"][0]["tasks"]
+    assert [(c["title"], c["sort_order"], c["completed"]) for c in cards] == [
+        ("Step A", 1, False),
+        ("Step B", 2, True),
+    ]
+    assert tasks[3]["sort_order"] is None
+
+    changed = client.get("/changes", params={"since": response.json()["cursor"] - 1}).json()
+    assert len(changed["tasks"]) == 3
+
+
+def test_backup_import(client):
+    """An app backup ({ decks } of camelCase cards) imports every root deck"""
+    backup = {"app": "one-job", "version": 3, "decks": [
+        {"id": "d1", "name": "Work", "cards": [
+            {"id": "c1", "title": "Ship it", "completed": False, "deferralCount": 2,
+             "createdAt": "2026-08-01T10:00:00.000Z",
+             "decks": [{"id": "i1", "name": None, "cards": [{"id": "c2", "title": "Tests", "completed": False}]}]},
+        ]},
+        {"id": "d2", "name": "Home", "cards": [
+            {"id": "c3", "title": "Laundry", "completed": True, "completedAt": "2026-08-02T10:00:00.000Z"},
+            {"id": "c4", "title": "Gone", "completed": False, "trashedAt": "2026-08-03T10:00:00.000Z"},
+        ]},
+    ]}
+    response = client.post("/import", json=backup)
+    assert response.status_code == 201
+
+    tasks = client.get("/tasks").json()
+    assert [(t["title"], t["status"]) for t in tasks] == [("Ship it", "todo"), ("Laundry", "done")]
+    assert tasks[0]["deferral_count"] == 2
+    assert tasks[0]["substacks"][0]["name"] == "Sub-tasks"
+    assert tasks[0]["substacks"][0]["tasks"][0]["title"] == "Tests"
+
+
+def test_import_is_all_or_nothing(client):
+    """A bad line rejects the whole import"""
+    body = '{"title": "Fine"}\n{"description": "no title"}\n'
+    response = client.post("/import", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Line 2:")
+    assert client.get("/tasks").json() == []
+
+
+def test_malformed_backup_decks_are_rejected(client):
+    """Decks that aren't objects, or whose cards aren't a list, get 400"""
+    for backup in ({"decks": [1]}, {"decks": [{"cards": None}]}, {"decks": [{"cards": []}, {"cards": {"0": {}}}]}):
+        response = client.post("/import", json=backup)
+        assert response.status_code == 400
+        assert response.json()["detail"].startswith("Deck ")
+    assert client.get("/tasks").json() == []
+
+
+def test_export_round_trips_through_import(client, monkeypatch):
+    """GET /export streams GET /tasks as NDJSON, and POST /import reads it back"""
+    monkeypatch.setattr("main.EXPORT_BATCH_SIZE", 2)
+    client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": f"Task {i}"} for i in range(5)
+    ] + [
+        {"op": "create_substack", "task_id": "$0", "name": "Steps"},
+        {"op": "add_substack_task", "substack_id": "$5", "title": "Step"},
+        {"op": "complete_task", "task_id": "$3"},
+    ]})
+
+    response = client.get("/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert exported == client.get("/tasks").json()
+
+    imported = client.post("/import", content=response.content, headers={"Content-Type": "application/x-ndjson"})
+    assert imported.json()["tasks"] == 5
+    assert imported.json()["substack_tasks"] == 1
+
+
+def test_task_list_wire_format_matches_task_response(client):
+    """The fast read path emits exactly what TaskResponse would"""
+    client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": "Task", "description": "With details"},
+        {"op": "create_substack", "task_id": "$0", "name": "Steps"},
+        {"op": "add_substack_task", "substack_id": "$1", "title": "Step"},
+        {"op": "complete_substack_task", "task_id": "$2"},
+        {"op": "create_task", "title": "Done"},
+        {"op": "complete_task", "task_id": "$4"},
+    ]})
+    lines = client.get("/export").content.splitlines()
+    assert client.get("/tasks").content == b"[" + b",".join(lines) + b"]"
+
+
+def read_all_pages(client, status, limit):
+    pages = []
+    cursor = None
+    while True:
+        params = {"status": status, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/tasks", params=params)
+        assert response.status_code == 200
+        pages.append([t["id"] for t in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return pages
+
+
+def test_paginated_task_views(client):
+    """Each pile pages with its own cursor and matches the full list order"""
+    ids = [
+        client.post("/tasks", json={"title": f"Task {i+1}"}).json()["id"]
+        for i in range(7)
+    ]
+    for task_id in ids[:3]:
+        client.put(f"/tasks/{task_id}", json={"status": "done"})
+
+    full = client.get("/tasks").json()
+    todo_pages = read_all_pages(client, "todo", limit=2)
+    done_pages = read_all_pages(client, "done", limit=2)
+
+    assert [len(p) for p in todo_pages] == [2, 2]
+    assert [len(p) for p in done_pages] == [2, 1]
+    assert sum(todo_pages + done_pages, []) == [t["id"] for t in full]
+
+
+def test_invalid_cursors_are_rejected(client):
+    """Garbage cursors and cursors from the other pile are a 400"""
+    for i in range(3):
+        client.post("/tasks", json={"title": f"Task {i+1}"})
+    todo_cursor = client.get("/tasks", params={"status": "todo", "limit": 1}).headers["X-Next-Cursor"]
+
+    assert client.get("/tasks", params={"status": "done", "cursor": todo_cursor}).status_code == 400
+    assert client.get("/tasks", params={"status": "todo", "cursor": "not-a-cursor"}).status_code == 400
+    assert client.get("/tasks", params={"cursor": todo_cursor}).status_code == 400
+
+    # Well-formed cursors whose keys overflow
+    def crafted(view, key):
+        raw = f'["{view}", {key}, "00000000-0000-0000-0000-000000000000"]'.encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    for key in ["1e400", str(10**30), str(-2**63 - 1), "NaN"]:
+        assert client.get("/tasks", params={"status": "todo", "cursor": crafted("todo", key)}).status_code == 400
+    for key in ["1e400", "-1e400", "NaN"]:
+        assert client.get("/search", params={"q": "task", "cursor": crafted("search", key)}).status_code == 400
+
+
+def test_sparse_fieldsets(client):
+    """fields= picks task fields (id always included); include=substacks adds the tree"""
+    task = client.post("/tasks", json={"title": "A", "description": "Long text"}).json()
+    client.post(f"/tasks/{task['id']}/substacks", json={"name": "S"})
+    client.post("/tasks", json={"title": "B"})
+
+    listed = client.get("/tasks", params={"fields": "title,status"}).json()
+    assert listed == [
+        {"id": task["id"], "title": "A", "status": "todo"},
+        {"id": listed[1]["id"], "title": "B", "status": "todo"},
+    ]
+    with_tree = client.get("/tasks/next", params={"fields": "title", "include": "substacks"}).json()
+    assert [s["name"] for s in with_tree[0]["substacks"]] == ["S"]
+    assert set(with_tree[0]) == {"id", "title", "substacks"}
+
+    # Pages still chain when the sort key itself wasn't asked for
+    first = client.get("/tasks", params={"status": "todo", "limit": 1, "fields": "title"})
+    assert first.json() == [{"id": task["id"], "title": "A"}]
+    second = client.get("/tasks", params={
+        "status": "todo", "limit": 1, "fields": "title", "cursor": first.headers["X-Next-Cursor"],
+    })
+    assert [t["title"] for t in second.json()] == ["B"]
+
+    assert client.get("/tasks", params={"fields": "title,secret"}).status_code == 400
+    assert client.get("/tasks", params={"include": "everything"}).status_code == 422
+
+
+def test_large_responses_are_gzipped(client):
+    """Big bodies are gzipped for clients that accept it; small ones are not"""
+    for i in range(30):
+        client.post("/tasks", json={"title": f"Task {i}", "description": "Some words " * 5})
+
+    compressed = client.get("/tasks", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert len(compressed.json()) == 30
+    small = client.get("/tasks/next", params={"fields": "title"}, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+
+def test_etags_are_per_deck(client):
+    """One deck's ETag never revalidates another deck's task list"""
+    mine, theirs = {"X-Deck-Id": "mine"}, {"X-Deck-Id": "theirs"}
+    client.post("/tasks", json={"title": "Mine"}, headers=mine)
+    client.post("/tasks", json={"title": "Theirs"}, headers=theirs)
+
+    etag = client.get("/tasks", headers=mine).headers["ETag"]
+    for path in ["/tasks", "/tasks/next"]:
+        response = client.get(path, headers={**theirs, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()
+    # Fresh, cached and 304 responses all vary by deck
+    assert "X-Deck-Id" in client.get("/tasks", headers=mine).headers["Vary"]
+    not_modified = client.get("/tasks", headers={**mine, "If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert "X-Deck-Id" in not_modified.headers["Vary"]
+    main.response_cache.invalidate()
+    assert "X-Deck-Id" in client.get("/tasks", headers=mine).headers["Vary"]
+
+
+def test_decks_are_isolated(client):
+    """Each X-Deck-Id sees, orders and versions only its own tasks"""
+    mine, theirs = {"X-Deck-Id": "mine"}, {"X-Deck-Id": "theirs"}
+    my_task = client.post("/tasks", json={"title": "Mine"}, headers=mine).json()
+    their_task = client.post("/tasks", json={"title": "Theirs"}, headers=theirs).json()
+    client.post("/tasks", json={"title": "Shared default"})
+
+    # Every deck starts its own order and its own version
+    assert my_task["sort_order"] == their_task["sort_order"] == 1
+    assert [t["title"] for t in client.get("/tasks", headers=mine).json()] == ["Mine"]
+    assert [t["title"] for t in client.get("/tasks").json()] == ["Shared default"]
+    assert client.get("/tasks", headers=theirs).headers["ETag"] == '"theirs:1"'
+    assert client.get("/changes", headers=theirs).json()["tasks"][0]["id"] == their_task["id"]
+
+    # Another deck's cards can't be read through or written to
+    assert client.put(f"/tasks/{my_task['id']}", json={"status": "done"}, headers=theirs).status_code == 404
+    assert client.post(f"/tasks/{my_task['id']}/substacks", json={"name": "S"}, headers=theirs).status_code == 404
+    substack = client.post(f"/tasks/{my_task['id']}/substacks", json={"name": "S"}, headers=mine).json()
+    assert client.post(f"/substacks/{substack['id']}/tasks", json={"title": "c"}, headers=theirs).status_code == 404
+    card = client.post(f"/substacks/{substack['id']}/tasks", json={"title": "c"}, headers=mine).json()
+    assert client.put(f"/substack-tasks/{card['id']}", json={"completed": True}, headers=theirs).status_code == 404
+
+    exported = client.get("/export", headers=mine).text.splitlines()
+    assert [json.loads(line)["title"] for line in exported] == ["Mine"]
+
+
+def test_existing_database_gains_deck_column(engine, client):
+    """Tasks stored before decks existed are migrated into the default deck"""
+    async def legacy_schema():
+        async with engine.begin() as conn:
+            await conn.execute(text("DROP TABLE schema_migrations"))
+            await conn.execute(text("DROP TABLE tasks"))
+            await conn.execute(text(
+                "CREATE TABLE tasks (id VARCHAR(36) PRIMARY KEY, title VARCHAR, description VARCHAR,"
+                " completed BOOLEAN, status VARCHAR, created_at DATETIME, completed_at DATETIME,"
+                " deferred_at DATETIME, deferral_count INTEGER, sort_order INTEGER,"
+                " external_id VARCHAR, source VARCHAR)"
+            ))
+            await conn.execute(text("CREATE INDEX ix_tasks_status_sort_order ON tasks (status, sort_order, id)"))
+            await conn.execute(text(
+                "INSERT INTO tasks VALUES ('00000000-0000-0000-0000-000000000001', 'Old', NULL, 0, 'todo',"
+                " '2025-01-01 00:00:00', NULL, NULL, 0, 1, NULL, NULL)"
+            ))
+
+    async def index_names():
+        async with engine.connect() as conn:
+            rows = await conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))
+            return {row[0] for row in rows}
+
+    client.portal.call(legacy_schema)
+    client.portal.call(migrate, engine)
+
+    assert [t["title"] for t in client.get("/tasks").json()] == ["Old"]
+    indexes = client.portal.call(index_names)
+    assert "ix_tasks_deck_id_status_sort_order" in indexes
+    assert "ix_tasks_status_sort_order" not in indexes
+
+
+def test_sqlite_file_profile(file_client):
+    """File databases run in WAL mode with the configured pragmas"""
+    readers, writer = file_client.engines
+
+    async def pragmas(engine):
+        async with engine.connect() as conn:
+            return {
+                name: (await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+                for name in ("journal_mode", "synchronous", "busy_timeout")
+            }
+
+    for engine in (readers, writer):
+        # synchronous=NORMAL reads back as 1
+        assert file_client.portal.call(pragmas, engine) == {
+            "journal_mode": "wal", "synchronous": 1, "busy_timeout": 5000,
+        }
+
+
+def test_reads_are_not_blocked_by_an_open_write(file_client):
+    """Readers keep answering while the writer holds the write lock"""
+    _, writer = file_client.engines
+    file_client.post("/tasks", json={"title": "Committed"})
+
+    # The read runs while the writer's transaction is open (and holds the
+    # write lock, having begun with BEGIN IMMEDIATE)
+    async def read_during_write():
+        async with writer.begin() as conn:
+            await conn.exec_driver_sql("UPDATE tasks SET title = 'Uncommitted'")
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+                response = await http.get("/tasks")
+            await conn.rollback()
+            return response
+
+    response = file_client.portal.call(read_during_write)
+    assert response.status_code == 200
+    assert [t["title"] for t in response.json()] == ["Committed"]
+
+
+def test_task_reads_see_one_snapshot(file_client, tmp_path):
+    """A task reactivated between a page's task and substack queries doesn't
+    show up in the second one (which would orphan its substacks)"""
+    readers, _ = file_client.engines
+    ids = file_client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": "Todo"},
+        {"op": "create_task", "title": "Done"},
+        {"op": "create_substack", "task_id": "$1", "name": "Steps"},
+        {"op": "add_substack_task", "substack_id": "$2", "title": "Step"},
+        {"op": "complete_task", "task_id": "$1"},
+    ]}).json()["ids"]
+
+    def reactivate_mid_read(conn, cursor, statement, parameters, context, executemany):
+        if "FROM substacks" in statement and not reactivated:
+            reactivated.append(True)
+            with sqlite3.connect(tmp_path / "onejob.db") as other:
+                other.execute(
+                    "UPDATE tasks SET status = 'todo', completed = 0, completed_at = NULL, sort_order = 0"
+                    " WHERE id = ?", (ids[1],),
+                )
+
+    reactivated = []
+    event.listen(readers.sync_engine, "before_cursor_execute", reactivate_mid_read)
+    try:
+        response = file_client.get("/tasks", params={"status": "todo"})
+    finally:
+        event.remove(readers.sync_engine, "before_cursor_execute", reactivate_mid_read)
+    assert reactivated
+    assert response.status_code == 200
+    assert [t["id"] for t in response.json()] == [ids[0]]
+
+    main.response_cache.invalidate()
+    assert [t["id"] for t in file_client.get("/tasks", params={"status": "todo"}).json()] == [ids[1], ids[0]]
+
+
+def stress_worker(url, worker, rounds):
+    """One server process of the stress test below: its own engines, with
+    several clients writing to the shared deck at once."""
+    readers, writer = create_sqlite_engine(url), create_sqlite_engine(url, writer=True)
+    app.dependency_overrides[get_sessionmaker] = lambda: async_sessionmaker(readers, expire_on_commit=False)
+    app.dependency_overrides[get_write_sessionmaker] = lambda: async_sessionmaker(writer, expire_on_commit=False)
+    main.response_cache.max_bytes = 0
+
+    async def client_session(http, name):
+        for i in range(rounds):
+            task = (await http.post("/tasks", json={"title": f"{name}-{i}"})).json()
+            assert (await http.put(f"/tasks/{task['id']}", json={"is_deferral": True})).status_code == 200
+            if i % 3 == 0:
+                assert (await http.put(f"/tasks/{task['id']}", json={"status": "done"})).status_code == 200
+                assert (await http.put(f"/tasks/{task['id']}", json={"status": "todo"})).status_code == 200
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            await asyncio.gather(*(client_session(http, f"w{worker}c{c}") for c in range(4)))
+        await readers.dispose()
+        await writer.dispose()
+
+    asyncio.run(run())
+
+
+def test_parallel_writers_keep_the_deck_order_consistent(file_client, tmp_path):
+    """Several server processes writing one deck never share or skip a position"""
+    url = f"sqlite+aiosqlite:///{tmp_path / 'onejob.db'}"
+    workers, rounds = 4, 6
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=stress_worker, args=(url, w, rounds)) for w in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+
+    tasks = file_client.get("/tasks").json()
+    orders = [t["sort_order"] for t in tasks]
+    assert len(tasks) == workers * 4 * rounds
+    assert all(t["status"] == "todo" for t in tasks)
+    assert len(set(orders)) == len(orders)
+    assert orders == sorted(orders)
+
+
+def test_write_conflicts_are_retried(client, monkeypatch):
+    """A write that hits a lock conflict is rerun, not failed"""
+    failures = iter([OperationalError("UPDATE", {}, Exception("database is locked"))])
+    write_create_task = main.write_create_task
+
+    async def flaky_create(db, task):
+        created = await write_create_task(db, task)
+        if (failure := next(failures, None)) is not None:
+            raise failure
+        return created
+
+    monkeypatch.setattr(main, "write_create_task", flaky_create)
+    response = client.post("/tasks", json={"title": "Eventually"})
+    assert response.status_code == 201
+    assert [t["title"] for t in client.get("/tasks").json()] == ["Eventually"]
+    assert client.get("/changes").json()["cursor"] == 1
+
+
+def read_event(client, stream):
+    """The next event of an event_stream(), as (id, data)."""
+    chunk = client.portal.call(stream.__anext__)
+    fields = dict(line.split(": ", 1) for line in chunk.strip().splitlines())
+    return int(fields["id"]), json.loads(fields["data"])
+
+
+def test_events_push_each_change(client, engine):
+    """An open /events stream receives every committed change as a delta"""
+    stream = main.event_stream(async_sessionmaker(engine, expire_on_commit=False), "default", None)
+    assert client.portal.call(stream.__anext__) == "retry: 3000\n\n"
+
+    task = client.post("/tasks", json={"title": "Pushed"}).json()
+    version, changes = read_event(client, stream)
+    assert version == 1
+    assert [t["title"] for t in changes["tasks"]] == ["Pushed"]
+
+    client.put(f"/tasks/{task['id']}", json={"status": "done"})
+    client.post(f"/tasks/{task['id']}/substacks", json={"name": "S"})
+    # Writes that land between reads arrive together
+    version, changes = read_event(client, stream)
+    assert version == 3
+    assert changes["cursor"] == 3
+    assert [s["name"] for s in changes["substacks"]] == ["S"]
+
+    client.post("/tasks", json={"title": "Elsewhere"}, headers={"X-Deck-Id": "other"})
+    client.portal.call(stream.aclose)
+    assert main.event_broker.subscribers == {}
+
+
+def test_events_resume_from_last_event_id(client, engine, monkeypatch):
+    """A reconnecting stream replays the changes after its Last-Event-ID"""
+    client.post("/tasks", json={"title": "Seen"})
+    client.post("/tasks", json={"title": "Missed"})
+
+    stream = main.event_stream(async_sessionmaker(engine, expire_on_commit=False), "default", 1)
+    client.portal.call(stream.__anext__)
+    version, changes = read_event(client, stream)
+    assert version == 2
+    assert [t["title"] for t in changes["tasks"]] == ["Missed"]
+
+    # An idle stream sends heartbeats
+    monkeypatch.setattr(main.settings, "EVENTS_HEARTBEAT_SECONDS", 0.01)
+    assert client.portal.call(stream.__anext__) == ": keep-alive\n\n"
+    client.portal.call(stream.aclose)
+
+    assert client.get("/events", headers={"Last-Event-ID": "9"}).status_code == 400
+
+
+def test_events_take_the_deck_from_the_query(client, monkeypatch):
+    """A browser EventSource, which can't send X-Deck-Id, names its deck in ?deck="""
+    client.post("/tasks", json={"title": "Theirs"}, headers={"X-Deck-Id": "theirs"})
+    streamed = []
+
+    async def event_stream(sessions, deck_id, since):
+        streamed.append((deck_id, since))
+        yield "retry: 3000\n\n"
+
+    monkeypatch.setattr(main, "event_stream", event_stream)
+    assert client.get("/events", params={"deck": "theirs", "since": 1}).status_code == 200
+    assert client.get("/events", params={"since": 1}).status_code == 400
+    assert streamed == [("theirs", 1)]
+    assert client.get("/events", params={"deck": ""}).status_code == 422
+
+
+def test_failed_publish_does_not_fail_the_write(client, monkeypatch, caplog):
+    """A broker failure after the commit is logged; the write still succeeds"""
+    async def publish(db, deck_id, version):
+        raise OSError("NOTIFY failed")
+
+    monkeypatch.setattr(main.event_broker, "publish", publish)
+    with caplog.at_level("ERROR", logger="onejob"):
+        created = client.post("/tasks", json={"title": "Kept"}, headers={"Idempotency-Key": "kept"})
+        imported = client.post("/import", content='{"title": "Imported"}\n', headers={"Content-Type": "application/x-ndjson"})
+    assert (created.status_code, imported.status_code) == (201, 201)
+    assert [t["title"] for t in client.get("/tasks").json()] == ["Kept", "Imported"]
+    assert len([r for r in caplog.records if r.getMessage().startswith("Publishing version")]) == 2
+
+    retry = client.post("/tasks", json={"title": "Kept"}, headers={"Idempotency-Key": "kept"})
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+
+def test_retried_writes_replay_the_first_response(client):
+    """A write retried with the same Idempotency-Key runs once"""
+    key = {"Idempotency-Key": "create-1"}
+    first = client.post("/tasks", json={"title": "Once"}, headers=key)
+    retry = client.post("/tasks", json={"title": "Once"}, headers=key)
+    assert retry.status_code == 201
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert len(client.get("/tasks").json()) == 1
+
+    task_id = first.json()["id"]
+    defer = {"Idempotency-Key": "defer-1"}
+    for _ in range(3):
+        response = client.put(f"/tasks/{task_id}", json={"is_deferral": True}, headers=defer)
+    assert response.json()["deferral_count"] == 1
+    assert client.get("/changes").json()["cursor"] == 2
+
+    # Keys belong to one request, and to one deck
+    assert client.put(f"/tasks/{task_id}", json={"status": "done"}, headers=key).status_code == 422
+    other_deck = client.post("/tasks", json={"title": "Once"}, headers={**key, "X-Deck-Id": "other"})
+    assert "Idempotent-Replayed" not in other_deck.headers
+
+
+def test_idempotency_keys_expire_and_skip_failures(client, monkeypatch):
+    """Client errors replay like successes, and keys are forgotten after the TTL"""
+    key = {"Idempotency-Key": "k"}
+    missing = "00000000-0000-0000-0000-000000000000"
+
+    # Client errors are answers too, and replay
+    assert client.put(f"/tasks/{missing}", json={"title": "x"}, headers=key).status_code == 404
+    assert client.put(f"/tasks/{missing}", json={"title": "x"}, headers=key).headers["Idempotent-Replayed"] == "true"
+
+    # Past the TTL the key is forgotten and the write runs again
+    monkeypatch.setattr(main.settings, "IDEMPOTENCY_TTL_SECONDS", 0)
+    client.post("/tasks", json={"title": "Again"}, headers={"Idempotency-Key": "ttl"})
+    client.post("/tasks", json={"title": "Again"}, headers={"Idempotency-Key": "ttl"})
+    assert len(client.get("/tasks").json()) == 2
+
+
+def test_concurrent_duplicate_is_refused(client, engine):
+    """A retry arriving while the first request still runs gets 409"""
+    async def claim():
+        async with async_sessionmaker(engine)() as db:
+            db.add(main.DBIdempotencyKey(
+                deck_id="default", key="busy", method="POST", path="/tasks",
+                created_at=main.datetime.now(main.timezone.utc),
+            ))
+            await db.commit()
+
+    client.portal.call(claim)
+    response = client.post("/tasks", json={"title": "Twice"}, headers={"Idempotency-Key": "busy"})
+    assert response.status_code == 409
+    assert client.get("/tasks").json() == []
+
+
+def test_idempotency_only_settles_its_own_claim(client, monkeypatch):
+    """A request whose key was dropped or reclaimed while it ran leaves it alone"""
+    write_create_task = main.write_create_task
+    claim = {}
+
+    async def create_and_lose_the_key(db, task):
+        created = await write_create_task(db, task)
+        if "reclaimed" in claim:
+            await db.execute(main.update(main.DBIdempotencyKey).values(created_at=claim["reclaimed"]))
+        else:
+            await db.execute(main.delete(main.DBIdempotencyKey))
+        return created
+
+    monkeypatch.setattr(main, "write_create_task", create_and_lose_the_key)
+    assert client.post("/tasks", json={"title": "Dropped"}, headers={"Idempotency-Key": "k"}).status_code == 201
+
+    # The later claim is still in progress; its retry is refused, not replayed
+    claim["reclaimed"] = main.datetime.now(main.timezone.utc) + main.timedelta(seconds=1)
+    assert client.post("/tasks", json={"title": "Reclaimed"}, headers={"Idempotency-Key": "r"}).status_code == 201
+    monkeypatch.setattr(main, "write_create_task", write_create_task)
+    assert client.post("/tasks", json={"title": "Reclaimed"}, headers={"Idempotency-Key": "r"}).status_code == 409
+
+
+def test_slow_keyed_writes_time_out_and_release_the_key(client, monkeypatch):
+    """A keyed write over IDEMPOTENCY_TIMEOUT_SECONDS gets 504 and may be retried"""
+    write_create_task = main.write_create_task
+
+    async def slow_create(db, task):
+        await asyncio.sleep(5)
+        return await write_create_task(db, task)
+
+    monkeypatch.setattr(main.settings, "IDEMPOTENCY_TIMEOUT_SECONDS", 0.05)
+    monkeypatch.setattr(main, "write_create_task", slow_create)
+    key = {"Idempotency-Key": "slow"}
+    assert client.post("/tasks", json={"title": "Slow"}, headers=key).status_code == 504
+    assert client.get("/tasks").json() == []
+
+    monkeypatch.setattr(main, "write_create_task", write_create_task)
+    retry = client.post("/tasks", json={"title": "Slow"}, headers=key)
+    assert retry.status_code == 201
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+def test_keyed_writes_that_committed_are_not_cancelled(client, monkeypatch):
+    """A keyed write past its timeout that has already committed finishes,
+    and a retry replays it rather than running it again"""
+    get_task_tree = main.get_task_tree
+
+    # The write itself commits well within the timeout; reading it back
+    # afterwards runs well past it
+    async def slow_tree(db, task_id):
+        await asyncio.sleep(1)
+        return await get_task_tree(db, task_id)
+
+    monkeypatch.setattr(main.settings, "IDEMPOTENCY_TIMEOUT_SECONDS", 0.5)
+    monkeypatch.setattr(main, "get_task_tree", slow_tree)
+    key = {"Idempotency-Key": "committed"}
+    first = client.post("/tasks", json={"title": "Once"}, headers=key)
+    assert first.status_code == 201
+
+    monkeypatch.setattr(main, "get_task_tree", get_task_tree)
+    retry = client.post("/tasks", json={"title": "Once"}, headers=key)
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert len(client.get("/tasks").json()) == 1
+
+
+def test_keyed_writes_that_fail_after_committing_keep_their_key(client, monkeypatch):
+    """A 500 raised after the commit is recorded, so the write isn't rerun"""
+    get_task_tree = main.get_task_tree
+
+    async def broken_tree(db, task_id):
+        raise RuntimeError("after the commit")
+
+    monkeypatch.setattr(main, "get_task_tree", broken_tree)
+    key = {"Idempotency-Key": "broken"}
+    no_raise = TestClient(client.app, raise_server_exceptions=False)
+    assert no_raise.post("/tasks", json={"title": "Once"}, headers=key).status_code == 500
+    assert no_raise.post("/tasks", json={"title": "Once"}, headers=key).headers["Idempotent-Replayed"] == "true"
+    monkeypatch.setattr(main, "get_task_tree", get_task_tree)
+    assert len(client.get("/tasks").json()) == 1
+
+
+def test_old_done_tasks_move_to_the_archive(client, engine, monkeypatch):
+    """Archiving moves old done tasks (substacks and all) out of GET /tasks;
+    GET /tasks/archived and /export still serve them"""
+    monkeypatch.setattr("main.ARCHIVE_BATCH_SIZE", 1)
+    ids = client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": f"Task {i}"} for i in range(4)
+    ] + [
+        {"op": "create_substack", "task_id": "$0", "name": "Steps"},
+        {"op": "add_substack_task", "substack_id": "$4", "title": "Step"},
+    ] + [
+        {"op": "complete_task", "task_id": f"${i}"} for i in range(3)
+    ]}).json()["ids"]
+
+    async def backdate():
+        async with engine.begin() as conn:
+            await conn.execute(
+                main.update(main.DBTask)
+                .where(main.DBTask.id.in_(ids[:2]))
+                .values(completed_at=main.datetime.now(main.timezone.utc) - main.timedelta(days=60))
+            )
+
+    client.portal.call(backdate)
+    main.response_cache.invalidate()
+    before = client.get("/tasks")
+    cursor = client.get("/changes").json()["cursor"]
+    sessions = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    assert client.portal.call(main.archive_done_tasks, sessions, main.timedelta(days=30)) == 2
+    assert client.portal.call(main.archive_done_tasks, sessions, main.timedelta(days=30)) == 0
+
+    # Syncing clients are told the tasks left the deck
+    changes = client.get("/changes", params={"since": cursor}).json()
+    assert sorted(changes["archived_task_ids"]) == sorted(ids[:2])
+    assert changes["tasks"] == []
+    assert client.get("/changes").json()["archived_task_ids"] == changes["archived_task_ids"]
+
+    after = client.get("/tasks", headers={"If-None-Match": before.headers["ETag"]})
+    assert after.status_code == 200
+    assert [t["id"] for t in after.json()] == [ids[3], ids[2]]
+
+    first = client.get("/tasks/archived", params={"limit": 1})
+    second = client.get("/tasks/archived", params={"limit": 1, "cursor": first.headers["X-Next-Cursor"]})
+    assert "X-Next-Cursor" not in second.headers
+    archived = first.json() + second.json()
+    assert sorted(archived, key=lambda t: t["id"]) == sorted(before.json()[2:], key=lambda t: t["id"])
+    assert [s["name"] for t in archived for s in t["substacks"]] == ["Steps"]
+
+    exported = [json.loads(line) for line in client.get("/export").text.splitlines()]
+    assert exported == after.json() + archived
+
+    async def child_rows():
+        async with engine.connect() as conn:
+            return [
+                (await conn.exec_driver_sql(f"SELECT count(*) FROM {table}")).scalar()
+                for table in ("substacks", "substack_tasks")
+            ]
+
+    assert client.portal.call(child_rows) == [0, 0]
+
+
+def test_search_finds_tasks_and_cards(client):
+    """GET /search matches word prefixes in titles and descriptions of both
+    tasks and substack cards, within the caller's deck, and follows writes"""
+    ids = client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": "Buy groceries", "description": "milk, eggs"},
+        {"op": "create_task", "title": "Plan the trip"},
+        {"op": "create_substack", "task_id": "$1", "name": "Packing"},
+        {"op": "add_substack_task", "substack_id": "$2", "title": "Pack snacks", "description": "Eggs for the road"},
+    ]}).json()["ids"]
+    client.post("/tasks", json={"title": "Eggs elsewhere"}, headers={"X-Deck-Id": "other"})
+
+    hits = client.get("/search", params={"q": "groc"}).json()
+    assert [(hit["kind"], hit["id"]) for hit in hits] == [("task", ids[0])]
+
+    hits = client.get("/search", params={"q": "EGGS!"}).json()
+    assert sorted((hit["kind"], hit["id"], hit["task_id"]) for hit in hits) == [
+        ("substack_task", ids[3], ids[1]), ("task", ids[0], ids[0]),
+    ]
+    assert client.get("/search", params={"q": "eggs road"}).json()[0]["id"] == ids[3]
+    assert client.get("/search", params={"q": "\"*"}).json() == []
+
+    client.put(f"/tasks/{ids[0]}", json={"title": "Buy bread"})
+    assert client.get("/search", params={"q": "groceries"}).json() == []
+    assert client.get("/search", params={"q": "bread"}).json()[0]["id"] == ids[0]
+
+
+def test_search_pages_through_ranked_results(client):
+    """Search results page with X-Next-Cursor, best matches first"""
+    client.post("/batch", json={"operations": [
+        {"op": "create_task", "title": f"Report {i}", "description": "report " * i} for i in range(5)
+    ]})
+    pages, cursor = [], None
+    while True:
+        params = {"q": "report", "limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/search", params=params)
+        pages.append(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [2, 2, 1]
+    hits = sum(pages, [])
+    assert hits == client.get("/search", params={"q": "report", "limit": 10}).json()
+    assert [hit["score"] for hit in hits] == sorted((hit["score"] for hit in hits), reverse=True)
+    assert hits[0]["title"] == "Report 4"
+
+
+def test_existing_database_is_indexed_for_search(client, engine):
+    """Rows written before the search index existed are found once a
+    migration builds it"""
+    client.post("/tasks", json={"title": "Old card"})
+
+    async def drop_index():
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql("DROP TABLE schema_migrations")
+            for table in main.SEARCH_TABLES:
+                await conn.exec_driver_sql(f"DROP TABLE {table}_fts")
+
+    client.portal.call(drop_index)
+    client.portal.call(migrate, engine)
+    main.response_cache.invalidate()
+    assert [hit["title"] for hit in client.get("/search", params={"q": "old"}).json()] == ["Old card"]
+
+
+def test_stats_roll_up_each_transition(client):
+    """GET /stats counts deferrals and completions per day from rollups
+    kept by the writes themselves, batches included"""
+    ids = [client.post("/tasks", json={"title": f"Task {i}"}).json()["id"] for i in range(3)]
+    client.put(f"/tasks/{ids[0]}", json={"is_deferral": True})
+    client.put(f"/tasks/{ids[0]}", json={"is_deferral": True})
+    client.put(f"/tasks/{ids[1]}", json={"status": "done"})
+    client.put(f"/tasks/{ids[1]}", json={"status": "todo"})
+    client.post("/batch", json={"operations": [
+        {"op": "defer_task", "task_id": ids[2]},
+        {"op": "complete_task", "task_id": ids[1]},
+        {"op": "complete_task", "task_id": ids[2]},
+    ]})
+    client.post("/tasks", json={"title": "Elsewhere"}, headers={"X-Deck-Id": "other"})
+
+    stats = client.get("/stats", params={"days": 7}).json()
+    assert len(stats["days"]) == 7
+    assert stats["days"][-1]["day"] == main.datetime.now(main.timezone.utc).date().isoformat()
+    assert stats["days"][-1] | {"day": None} == {"day": None, "completed": 3, "deferred": 3}
+    assert (stats["completed"], stats["deferred"]) == (3, 3)
+    assert [(t["id"], t["deferral_count"]) for t in stats["most_deferred"]] == [(ids[0], 2), (ids[2], 1)]
+    assert stats["time_to_done"]["median_bucket"] == "1h"
+    assert stats["time_to_done"]["median_seconds"] < 60
+    assert stats["time_to_done"]["buckets"]["1h"] == 3
+    assert sum(stats["time_to_done"]["buckets"].values()) == 3
+
+    other = client.get("/stats", headers={"X-Deck-Id": "other"}).json()
+    assert (other["completed"], other["deferred"], other["most_deferred"]) == (0, 0, [])
+    assert other["time_to_done"]["median_bucket"] is None
+    assert other["time_to_done"]["median_seconds"] is None
+
+
+def test_app_boots_without_touching_the_database(tmp_path):
+    """create_app() and startup do no schema work; `migrate` does it once"""
+    path = tmp_path / "onejob.db"
+    url = f"sqlite:///{path}"
+    with TestClient(main.create_app(url)):
+        pass
+    assert not path.exists()
+
+    assert asyncio.run(main.migrate_database(url)) == main.SCHEMA_VERSION
+    assert asyncio.run(main.migrate_database(url)) == main.SCHEMA_VERSION
+    with TestClient(main.create_app(url)) as client:
+        assert client.post("/tasks", json={"title": "Booted"}).status_code == 201
+        assert [t["title"] for t in client.get("/tasks").json()] == ["Booted"]
+
+
+def test_migrations_are_recorded_and_run_once(client, engine, statements):
+    """Each migration is applied once; an up-to-date database costs one check"""
+    async def applied():
+        async with engine.connect() as conn:
+            return (await conn.exec_driver_sql("SELECT version FROM schema_migrations")).scalars().all()
+
+    assert client.portal.call(applied) == list(range(1, main.SCHEMA_VERSION + 1))
+    statements.clear()
+    client.portal.call(migrate, engine)
+    assert not [s for s in statements if s.lstrip().upper().startswith(("CREATE", "ALTER", "DROP", "INSERT"))]
+    assert client.portal.call(applied) == list(range(1, main.SCHEMA_VERSION + 1))
+
+
+def test_task_status_is_todo_or_done(client):
+    """Any other status is rejected, so every done task pages by completed_at"""
+    task = client.post("/tasks", json={"title": "Task"}).json()
+    assert client.put(f"/tasks/{task['id']}", json={"status": "later"}).status_code == 422
+    assert client.put(f"/tasks/{task['id']}", json={"status": "done"}).json()["completed_at"] is not None
+
+
+def test_migration_repairs_tasks_outside_the_piles(client, engine):
+    """Tasks stored with another status, or done without a completed_at,
+    are put back where paging finds them"""
+    ids = [client.post("/tasks", json={"title": f"Task {i}"}).json()["id"] for i in range(3)]
+
+    async def corrupt():
+        async with engine.begin() as conn:
+            await conn.execute(text("DELETE FROM schema_migrations WHERE version > 1"))
+            await conn.execute(text("UPDATE tasks SET status = 'later', sort_order = NULL WHERE id = :id"), {"id": ids[0]})
+            await conn.execute(text(
+                "UPDATE tasks SET status = 'done', completed = 1, sort_order = NULL WHERE id = :id"
+            ), {"id": ids[1]})
+
+    client.portal.call(corrupt)
+    client.portal.call(migrate, engine)
+    main.response_cache.invalidate()
+
+    assert sum(read_all_pages(client, "todo", limit=1), []) == [ids[2], ids[0]]
+    assert sum(read_all_pages(client, "done", limit=1), []) == [ids[1]]
+
+
+
+def test_imported_history_counts_in_stats(client):
+    """Imported completions (and deferrals) land in GET /stats on their own
+    days; done tasks without a completed_at are not counted"""
+    now = main.datetime.now(main.timezone.utc)
+    two_days_ago = (now - main.timedelta(days=2)).isoformat()
+    lines = [
+        {"title": "Done", "status": "done", "created_at": (now - main.timedelta(days=4)).isoformat(),
+         "completed_at": two_days_ago},
+        {"title": "Done too", "status": "done", "completed_at": two_days_ago},
+        {"title": "Done some time", "status": "done"},
+        {"title": "Put off", "deferred_at": now.isoformat(), "deferral_count": 3},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\n"
+    assert client.post("/import", content=body, headers={"Content-Type": "application/x-ndjson"}).status_code == 201
+
+    stats = client.get("/stats", params={"days": 7}).json()
+    assert [(day["completed"], day["deferred"]) for day in stats["days"][-3:]] == [(2, 0), (0, 0), (0, 3)]
+    assert stats["time_to_done"]["buckets"]["3d"] == 1
+    assert stats["time_to_done"]["buckets"]["1h"] == 1
+    # Two days (to two significant figures) and none: the median is between
+    assert stats["time_to_done"]["median_seconds"] == 85000
+
+
+def test_migration_backfills_stats(client, engine):
+    """History from before the rollups is counted, without touching days
+    they already cover"""
+    ids = [client.post("/tasks", json={"title": f"Task {i}"}).json()["id"] for i in range(3)]
+    for task_id in ids[:2]:
+        client.put(f"/tasks/{task_id}", json={"status": "done"})
+    client.put(f"/tasks/{ids[2]}", json={"is_deferral": True})
+    theirs = client.post("/tasks", json={"title": "Theirs"}, headers={"X-Deck-Id": "theirs"}).json()
+    for _ in range(2):
+        client.put(f"/tasks/{theirs['id']}", json={"is_deferral": True}, headers={"X-Deck-Id": "theirs"})
+
+    async def forget_history():
+        now = main.datetime.now(main.timezone.utc)
+        async with engine.begin() as conn:
+            await conn.execute(text("DELETE FROM schema_migrations WHERE version > 2"))
+            await conn.execute(
+                main.update(main.DBTask).where(main.DBTask.id == ids[0])
+                .values(created_at=now - main.timedelta(days=4), completed_at=now - main.timedelta(days=3))
+            )
+            await conn.execute(text("DELETE FROM daily_stats WHERE deck_id = 'theirs'"))
+            await conn.execute(text("DROP TABLE done_times"))
+
+    client.portal.call(forget_history)
+    client.portal.call(migrate, engine)
+
+    stats = client.get("/stats", params={"days": 7}).json()
+    assert [(day["completed"], day["deferred"]) for day in stats["days"][-4:]] == [(1, 0), (0, 0), (0, 0), (2, 1)]
+    assert stats["time_to_done"]["buckets"]["1d"] == 1
+    # One day (86000 s to two significant figures) and none
+    assert stats["time_to_done"]["median_seconds"] == 43000
+    their_stats = client.get("/stats", headers={"X-Deck-Id": "theirs"}).json()
+    assert (their_stats["completed"], their_stats["deferred"]) == (0, 2)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
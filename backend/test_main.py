@@ -77,5 +77,22 @@ def test_defer_task(client):
     assert data["deferred_at"] is not None
     assert data["deferral_count"] == 1
 
+def test_get_next_tasks(client):
+    """Test reading the top of the deck"""
+    assert client.get("/tasks/next").json() == []
+
+    ids = [
+        client.post("/tasks", json={"title": f"Task {i}"}).json()["id"]
+        for i in range(4)
+    ]
+    client.put(f"/tasks/{ids[0]}", json={"is_deferral": True})
+
+    response = client.get("/tasks/next")
+    assert response.status_code == 200
+    assert [t["id"] for t in response.json()] == [ids[1]]
+
+    peek = client.get("/tasks/next", params={"n": 3}).json()
+    assert [t["id"] for t in peek] == [ids[1], ids[2], ids[3]]
+
 if __name__ == "__main__":
     pytest.main([__file__])
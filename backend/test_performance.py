@@ -0,0 +1,349 @@
+"""
+Performance guards for the One Job API
+
+These don't time anything; they pin down how much work an endpoint does
+(queries issued, rows touched) so regressions show up as failures rather
+than as a slow production deck.
+"""
+
+import json
+
+import pytest
+
+import main
+
+
+def create_tasks_with_substacks(client, count, substacks=2, cards=3):
+    for i in range(count):
+        task = client.post("/tasks", json={"title": f"Task {i}"}).json()
+        for s in range(substacks):
+            substack = client.post(
+                f"/tasks/{task['id']}/substacks", json={"name": f"Substack {s}"}
+            ).json()
+            for c in range(cards):
+                client.post(f"/substacks/{substack['id']}/tasks", json={"title": f"Card {c}"})
+
+
+def count_get_tasks_queries(client, statements):
+    statements.clear()
+    response = client.get("/tasks")
+    assert response.status_code == 200
+    return len(statements)
+
+
+def test_get_tasks_query_count_is_constant(client, statements):
+    """Loading the task list must not issue a query per task or substack"""
+    create_tasks_with_substacks(client, 2)
+    small = count_get_tasks_queries(client, statements)
+
+    create_tasks_with_substacks(client, 10)
+    large = count_get_tasks_queries(client, statements)
+
+    assert large == small
+    assert small <= 6
+
+
+def task_updates(statements):
+    return [s for s in statements if s.startswith("UPDATE tasks")]
+
+
+def test_reordering_writes_only_the_moved_task(client, statements):
+    """Defer, complete and reactivate each update one row, not the deck"""
+    ids = [client.post("/tasks", json={"title": f"Task {i}"}).json()["id"] for i in range(20)]
+
+    for body, task_id in [
+        ({"is_deferral": True}, ids[0]),
+        ({"status": "done"}, ids[5]),
+        ({"status": "todo"}, ids[5]),
+    ]:
+        statements.clear()
+        assert client.put(f"/tasks/{task_id}", json=body).status_code == 200
+        updates = task_updates(statements)
+        assert len(updates) == 1
+        assert "WHERE tasks.id = ?" in updates[0]
+
+
+def query_plan(client, engine, sql):
+    """SQLite's EXPLAIN QUERY PLAN for a statement, as one string."""
+    async def explain():
+        async with engine.connect() as conn:
+            rows = (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")).all()
+        return " ".join(str(row[-1]) for row in rows)
+
+    return client.portal.call(explain)
+
+
+def test_task_piles_are_read_in_index_order(client, engine):
+    """Both piles of a deck come off a composite index, not a sort"""
+    todo_plan = query_plan(
+        client, engine,
+        "SELECT * FROM tasks WHERE deck_id = 'a' AND status = 'todo' ORDER BY sort_order, id",
+    )
+    done_plan = query_plan(
+        client, engine,
+        "SELECT * FROM tasks WHERE deck_id = 'a' AND status = 'done' ORDER BY completed_at DESC, id DESC",
+    )
+    assert "ix_tasks_deck_id_status_sort_order" in todo_plan
+    assert "ix_tasks_deck_id_status_completed_at" in done_plan
+    assert "TEMP B-TREE" not in todo_plan + done_plan
+
+
+def test_rank_lookups_stay_within_the_deck(client, engine):
+    """Finding the bottom or top of a deck is a seek into that deck alone"""
+    plan = query_plan(
+        client, engine,
+        "SELECT max(sort_order) FROM tasks WHERE deck_id = 'a' AND status = 'todo'",
+    )
+    assert "SEARCH tasks USING COVERING INDEX ix_tasks_deck_id_status_sort_order" in plan
+
+
+def test_children_are_read_by_parent_index(client, engine):
+    """Loading a page's substacks and cards seeks by parent instead of scanning"""
+    substack_plan = query_plan(
+        client, engine,
+        "SELECT * FROM substacks WHERE parent_task_id IN ('a', 'b') ORDER BY created_at",
+    )
+    card_plan = query_plan(
+        client, engine,
+        "SELECT * FROM substack_tasks WHERE substack_id IN ('a', 'b') ORDER BY sort_order",
+    )
+    assert "ix_substacks_parent_task_id_created_at" in substack_plan
+    assert "ix_substack_tasks_substack_id_sort_order" in card_plan
+
+
+def test_next_task_query_count_is_constant(client, statements):
+    """The top card costs the same whatever the deck size"""
+    create_tasks_with_substacks(client, 2)
+    statements.clear()
+    client.get("/tasks/next")
+    small = len(statements)
+
+    create_tasks_with_substacks(client, 10)
+    statements.clear()
+    client.get("/tasks/next")
+
+    assert len(statements) == small
+    assert any("FROM tasks" in s and "LIMIT" in s for s in statements)
+
+
+def test_not_modified_skips_the_task_tables(client, statements):
+    """A conditional GET for an unchanged deck never reads the tasks tables"""
+    create_tasks_with_substacks(client, 3)
+    etag = client.get("/tasks").headers["ETag"]
+
+    statements.clear()
+    response = client.get("/tasks", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert not any("tasks" in s.replace("deck_state", "") for s in statements)
+
+
+def test_repeat_reads_are_served_from_the_cache(client, statements):
+    """A cached task read issues no SQL; a write invalidates it"""
+    create_tasks_with_substacks(client, 3)
+    hits_before = client.get("/cache/stats").json()["hits"]
+    first = client.get("/tasks")
+
+    statements.clear()
+    again = client.get("/tasks")
+    assert statements == []
+    assert again.content == first.content
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert client.get("/tasks", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+    assert statements == []
+
+    client.post("/tasks", json={"title": "New"})
+    statements.clear()
+    fresh = client.get("/tasks")
+    assert statements
+    assert len(fresh.json()) == 4
+
+    stats = client.get("/cache/stats").json()
+    assert stats["hits"] - hits_before == 2
+    assert stats["entries"] == 1
+
+
+def test_cache_evicts_least_recently_used(client, monkeypatch):
+    """The cache stays under its byte budget by dropping the oldest entries"""
+    create_tasks_with_substacks(client, 3, substacks=0)
+    client.get("/tasks")
+    monkeypatch.setattr(main.response_cache, "max_bytes", client.get("/cache/stats").json()["bytes"] + 10)
+
+    client.get("/tasks/next")
+    client.get("/tasks/next", params={"n": 2})
+
+    stats = client.get("/cache/stats").json()
+    assert stats["evictions"] >= 1
+    assert stats["bytes"] <= stats["max_bytes"]
+
+
+def test_cache_ignores_reads_that_raced_a_write():
+    """An entry read before an invalidation is not stored after it"""
+    cache = main.ResponseCache(1024)
+    key = ("default", "/tasks?[]")
+    generation = cache.generation("default")
+    cache.invalidate("default")
+    cache.put(key, b"[]", {"etag": '"1"'}, generation)
+    assert cache.entries == {}
+
+
+def test_cache_counts_keys_headers_and_entries():
+    """Small responses are charged for their keys and headers, and capped in number"""
+    cache = main.ResponseCache(1024 * 1024, max_entries=3)
+    headers = {"etag": '"1"', "content-type": "application/json"}
+    for n in range(5):
+        cache.put(("default", f"/tasks?{n}"), b"[]", headers, cache.generation("default"))
+
+    assert len(cache.entries) == 3
+    assert cache.evictions == 2
+    assert cache.size == 3 * main.ResponseCache.cost(("default", "/tasks?4"), b"[]", headers)
+    assert cache.size > 3 * (len(b"[]") + main.ResponseCache.ENTRY_OVERHEAD)
+
+
+def test_cache_generations_stay_bounded():
+    """Writing to ever more decks does not keep a generation for each of them"""
+    cache = main.ResponseCache(1024 * 1024, max_entries=10)
+    for n in range(100):
+        cache.invalidate(f"deck-{n}")
+    assert len(cache.generations) <= 10
+
+    key = ("deck-99", "/tasks?[]")
+    generation = cache.generation("deck-99")
+    cache.invalidate("deck-99")
+    cache.put(key, b"[]", {}, generation)
+    assert cache.entries == {}
+
+
+def test_cache_follows_other_workers_writes(monkeypatch):
+    """Postgres notifications clear a deck's cached reads in every worker,
+    and without them several workers don't cache at all"""
+    key = ("default", "/tasks?[]")
+    main.response_cache.put(key, b"[]", {"etag": '"default:1"'}, main.response_cache.generation("default"))
+    broker = main.PostgresBroker("postgresql://unused")
+    broker.notified(None, 0, main.EVENTS_CHANNEL, json.dumps(["default", 2]))
+    assert main.response_cache.get(key) is None
+
+    monkeypatch.setattr(main.settings, "WEB_CONCURRENCY", 4)
+    assert main.response_cache_bytes() == 0
+    monkeypatch.setattr(main.settings, "EVENTS_BROKER", "postgres")
+    assert main.response_cache_bytes() == main.settings.RESPONSE_CACHE_BYTES
+
+
+def test_cache_is_invalidated_per_deck(client, statements):
+    """A write to one deck leaves other decks' cached reads in place"""
+    client.post("/tasks", json={"title": "Mine"}, headers={"X-Deck-Id": "mine"})
+    client.get("/tasks", headers={"X-Deck-Id": "mine"})
+    client.get("/tasks", headers={"X-Deck-Id": "theirs"})
+
+    client.post("/tasks", json={"title": "Theirs"}, headers={"X-Deck-Id": "theirs"})
+    statements.clear()
+    client.get("/tasks", headers={"X-Deck-Id": "mine"})
+    assert statements == []
+    assert len(client.get("/tasks", headers={"X-Deck-Id": "theirs"}).json()) == 1
+
+
+def test_sparse_lists_select_only_what_they_return(client, statements):
+    """A fields= list reads just those columns, and no substack tables"""
+    create_tasks_with_substacks(client, 3)
+    statements.clear()
+    client.get("/tasks", params={"status": "todo", "fields": "id,title,status,sort_order"})
+
+    task_queries = [s for s in statements if "FROM tasks" in s]
+    assert len(task_queries) == 1
+    assert "description" not in task_queries[0]
+    assert not any("substack" in s for s in statements)
+
+
+def test_substack_tasks_come_back_in_sort_order(client):
+    """Substack cards are returned ordered by sort_order"""
+    create_tasks_with_substacks(client, 1, substacks=1, cards=5)
+
+    substack = client.get("/tasks").json()[0]["substacks"][0]
+    orders = [card["sort_order"] for card in substack["tasks"]]
+    assert orders == sorted(orders)
+    assert len(orders) == 5
+
+
+def metric_value(client, line_prefix):
+    for line in client.get("/metrics").text.splitlines():
+        if line.startswith(line_prefix + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_metrics_count_requests_and_sql_by_route(client, statements):
+    """/metrics reports each route by template, with the SQL it ran"""
+    task_id = client.post("/tasks", json={"title": "Measured"}).json()["id"]
+    route = 'method="PUT",route="/tasks/{task_id}"'
+    count = f"onejob_http_request_duration_seconds_count{{{route}}}"
+    sql = f"onejob_sql_statements_per_request_sum{{{route}}}"
+    before_count, before_sql = metric_value(client, count), metric_value(client, sql)
+
+    statements.clear()
+    client.put(f"/tasks/{task_id}", json={"is_deferral": True})
+    issued = len(statements)
+
+    assert metric_value(client, count) == before_count + 1
+    assert metric_value(client, sql) == before_sql + issued
+    assert metric_value(client, f'onejob_http_responses_total{{{route},status="200"}}') >= 1
+    assert "onejob_http_requests_in_flight 1" in client.get("/metrics").text
+
+
+def test_slow_requests_log_their_statements(client, monkeypatch, caplog):
+    """A request over SLOW_REQUEST_MS is logged with the SQL it ran"""
+    monkeypatch.setattr(main.settings, "SLOW_REQUEST_MS", 0.001)
+    with caplog.at_level("WARNING", logger="onejob"):
+        client.post("/tasks", json={"title": "Slow"})
+
+    [record] = [r for r in caplog.records if r.getMessage().startswith("Slow request: POST /tasks")]
+    assert "INSERT INTO tasks" in record.getMessage()
+
+
+def test_archive_pages_come_off_its_index(client, engine):
+    """Paging through archived history is an index scan within the deck"""
+    plan = query_plan(
+        client, engine,
+        "SELECT document FROM tasks_archive WHERE deck_id = 'a' ORDER BY completed_at DESC, id DESC",
+    )
+    assert "ix_tasks_archive_deck_id_completed_at" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_search_uses_the_full_text_index(client, engine):
+    """A search is driven by the FTS matches, fetching rows by rowid, rather
+    than by walking the deck"""
+    plan = query_plan(
+        client, engine,
+        main.SQLITE_SEARCH.replace(":query", "'eggs'").replace(":deck_id", "'a'"),
+    )
+    assert "SCAN tasks_fts VIRTUAL TABLE INDEX 0:M" in plan
+    assert "SCAN substack_tasks_fts VIRTUAL TABLE INDEX 0:M" in plan
+    assert "SEARCH tasks USING INTEGER PRIMARY KEY (rowid=?)" in plan
+    assert "SEARCH substack_tasks USING INTEGER PRIMARY KEY (rowid=?)" in plan
+
+
+def test_stats_cost_does_not_grow_with_the_deck(client, engine, statements):
+    """GET /stats reads rollups and an index top-n, not the task table"""
+    def count_stats_queries():
+        statements.clear()
+        assert client.get("/stats").status_code == 200
+        return len(statements)
+
+    ids = [client.post("/tasks", json={"title": f"Task {i}"}).json()["id"] for i in range(2)]
+    client.put(f"/tasks/{ids[0]}", json={"status": "done"})
+    small = count_stats_queries()
+    ids = [client.post("/tasks", json={"title": f"Task {i}"}).json()["id"] for i in range(10)]
+    for task_id in ids:
+        client.put(f"/tasks/{task_id}", json={"is_deferral": True})
+    assert count_stats_queries() == small
+
+    plan = query_plan(
+        client, engine,
+        "SELECT id FROM tasks WHERE deck_id = 'a' AND deferral_count > 0 "
+        "ORDER BY deferral_count DESC, id DESC LIMIT 10",
+    )
+    assert "ix_tasks_deck_id_deferral_count" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])